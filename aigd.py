@@ -1,4 +1,11 @@
+import os
+import mmap
+import fcntl
+import atexit
 import random
+import collections
+
+import numpy
 
 from player import Bot 
 
@@ -98,77 +105,210 @@ class LogicalBot(Bot):
         return self.spy
 
 
-class Variable(object):
-    def __init__(self):
-        self.total = 0
-        self.samples = 0
+# Attributes learned about each opponent, as columns of the global statistics.
+ATTRIBUTES = ('spy_VotesForSpy', 'spy_VotesForRes', 'spy_PicksSpy', 'spy_PicksSelf',
+              'res_VotesForSpy', 'res_VotesForRes', 'res_PicksSpy', 'res_PicksSelf',
+              'spy_Sabotage')
 
-    def sample(self, value):
-        self.total += value
-        self.samples += 1
+SPY_VOTES_FOR_SPY, SPY_VOTES_FOR_RES, SPY_PICKS_SPY, SPY_PICKS_SELF, \
+RES_VOTES_FOR_SPY, RES_VOTES_FOR_RES, RES_PICKS_SPY, RES_PICKS_SELF, \
+SPY_SABOTAGE = range(len(ATTRIBUTES))
 
-    def estimate(self):
-        if self.samples > 0:
-            return float(self.total) / float(self.samples)
-        else:
-            return 0.5
 
-    def __repr__(self):
-        if self.samples:
-            return "%0.2f%% (%i)" % ((100.0 * float(self.total) / float(self.samples)), self.samples)
-        else:
-            return "UNKNOWN"
-
-
-class GlobalStatistics(object):
-    def __init__(self):
-        self.spy_VotesForSpy = Variable()
-        self.spy_VotesForRes = Variable()
-        self.spy_PicksSpy = Variable()
-        self.spy_PicksSelf = Variable()
-        self.res_VotesForSpy = Variable()
-        self.res_VotesForRes = Variable()
-        self.res_PicksSpy = Variable()
-        self.res_PicksSelf = Variable()
-        self.spy_Sabotage = Variable()
-
-    def __repr__(self):
-        return """
-As Spy, VOTES:  Spy %s  Res  %s
-        PICKS:  Spy %s  Self %s
-        SABOTAGE    %s
-As Res, VOTES:  Spy %s  Res  %s
-        PICKS:  Spy %s  Self %s
-""" % (self.spy_VotesForSpy, self.spy_VotesForRes, self.spy_PicksSpy, self.spy_PicksSelf, self.spy_Sabotage, self.res_VotesForSpy, self.res_VotesForRes, self.res_PicksSpy, self.res_PicksSelf)
-
-
-class LocalStatistics(object):
-    def __init__(self):
-        self.probability = Variable()
-        # Chances of being one of the two spies out of the other four are 50%.
-        self.probability.sample(0.5) 
+class StatisticsStore(object):
+    """Append-only file of global statistics so that what's learned about
+    opponents survives restarts.  Each fixed-size record holds the totals and
+    samples for one opponent, and all records with the same name are summed
+    when loading.  Multiple processes can append to the same file, and it gets
+    compacted down to one record per name once it has grown too much."""
 
-    def update(self, probability):
-        self.probability.sample(probability)
+    RECORD = numpy.dtype([('name', 'S64'),
+                          ('totals', '<f8', (len(ATTRIBUTES),)),
+                          ('samples', '<u8', (len(ATTRIBUTES),))])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = 0
+        self.names = 0
+
+    def _open(self, mode, lock):
+        # Compaction replaces the file, so make sure the lock is on the
+        # current one before using it.
+        while True:
+            f = open(self.filename, mode)
+            fcntl.flock(f, lock)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.filename).st_ino:
+                    return f
+            except OSError:
+                pass
+            f.close()
+
+    def _read(self, f):
+        result = {}
+        count = os.fstat(f.fileno()).st_size / self.RECORD.itemsize
+        if count == 0:
+            return result
+
+        data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        records = numpy.frombuffer(data, self.RECORD, count)
+        for name, totals, samples in records:
+            t, s = result.setdefault(name, (numpy.zeros(len(ATTRIBUTES)), numpy.zeros(len(ATTRIBUTES))))
+            t += totals
+            s += samples
+        del records
+        data.close()
+
+        self.records = count
+        self.names = len(result)
+        return result
+
+    def _write(self, f, statistics):
+        records = numpy.zeros(len(statistics), self.RECORD)
+        for r, (name, (totals, samples)) in zip(records, statistics.items()):
+            r['name'], r['totals'], r['samples'] = name[:64], totals, samples
+        f.write(records.tostring())
+
+    def load(self):
+        """Returns the totals and samples for all opponents, by name."""
+        try:
+            with self._open('rb', fcntl.LOCK_SH) as f:
+                return self._read(f)
+        except IOError:
+            return {}
+
+    def append(self, statistics):
+        """Add new totals and samples, given by name, to the store."""
+        if not os.path.exists(self.filename):
+            open(self.filename, 'ab').close()
+        with self._open('ab', fcntl.LOCK_EX) as f:
+            self._write(f, statistics)
+        self.records += len(statistics)
+
+        if self.records > 2 * self.names + 1000:
+            self.compact()
+
+    def compact(self):
+        with self._open('rb', fcntl.LOCK_EX) as f:
+            statistics = self._read(f)
+            with open(self.filename + '.tmp', 'wb') as output:
+                self._write(output, statistics)
+            os.rename(self.filename + '.tmp', self.filename)
+        self.records = self.names
+
+
+class StatisticsCache(object):
+    """Global statistics for opponents in dense arrays, with one row for each
+    name and one column for each attribute.  Once all `capacity` rows are in
+    use, the least recently seen opponent is forgotten to make room."""
+
+    def __init__(self, capacity):
+        shape = (capacity, len(ATTRIBUTES))
+        self.totals = numpy.zeros(shape)
+        self.samples = numpy.zeros(shape)
+        # Same again for samples that were not yet written to the store.
+        self.unsaved_totals = numpy.zeros(shape)
+        self.unsaved_samples = numpy.zeros(shape)
+        self.evicted = {}
+        self.rows = collections.OrderedDict()
+
+    def fetch(self, name):
+        row = self.rows.pop(name, None)
+        if row is None:
+            if len(self.rows) < len(self.totals):
+                row = len(self.rows)
+            else:
+                old, row = self.rows.popitem(last = False)
+                self._evict(old, row)
+        self.rows[name] = row
+        return row
+
+    def _evict(self, name, row):
+        if self.unsaved_samples[row].any():
+            t, s = self.evicted.setdefault(name, (numpy.zeros(len(ATTRIBUTES)), numpy.zeros(len(ATTRIBUTES))))
+            t += self.unsaved_totals[row]
+            s += self.unsaved_samples[row]
+        for a in (self.totals, self.samples, self.unsaved_totals, self.unsaved_samples):
+            a[row] = 0.0
+
+    def warm(self, name, totals, samples):
+        row = self.fetch(name)
+        self.totals[row] += totals
+        self.samples[row] += samples
+
+    def sample(self, rows, columns, values):
+        for totals, samples in ((self.totals, self.samples), (self.unsaved_totals, self.unsaved_samples)):
+            numpy.add.at(totals, (rows, columns), values)
+            numpy.add.at(samples, (rows, columns), 1.0)
+
+    def estimate(self, row, column):
+        samples = self.samples[row, column]
+        if samples > 0:
+            return float(self.totals[row, column] / samples)
+        return 0.5
+
+    def unsaved(self):
+        """Returns the samples not yet written to the store by name, then
+        forgets about them."""
+        result, self.evicted = self.evicted, {}
+        for name, row in self.rows.items():
+            if self.unsaved_samples[row].any():
+                result[name] = (self.unsaved_totals[row].copy(), self.unsaved_samples[row].copy())
+        self.unsaved_totals[:] = 0.0
+        self.unsaved_samples[:] = 0.0
+        return result
 
 
 class Statistician(Bot):
 
-    global_statistics = {}
+    # Bounded so that very long competitions run in constant memory.
+    global_statistics = StatisticsCache(capacity = 1000)
+
+    # Statistics are loaded from disk on startup, and new samples are
+    # appended back every so many games.
+    database = StatisticsStore('logs/Statistician.db')
+    loaded = False
+    games = 0
+    SAVE_GAMES = 250
+
+    @classmethod
+    def load(cls):
+        cls.loaded = True
+        for name, (totals, samples) in cls.database.load().items():
+            cls.global_statistics.warm(name, totals, samples)
+        atexit.register(cls.save)
+
+    @classmethod
+    def save(cls):
+        unsaved = cls.global_statistics.unsaved()
+        if not unsaved:
+            return
+        try:
+            cls.database.append(unsaved)
+        except IOError:
+            pass
+
+    @classmethod
+    def onCompetitionFinished(cls):
+        cls.save()
 
     def onGameRevealed(self, players, spies):
+        if not self.loaded:
+            self.load()
+
         self.spies = spies
         self.players = players
 
         self.missions = []
         self.selections = []
         self.votes = []
-        self.local_statistics = {}
 
-        # Set the default value for global stats.
-        for p in players:
-            self.global_statistics.setdefault(p.name, GlobalStatistics())
-            self.local_statistics.setdefault(p.name, LocalStatistics())
+        # Rows of the global statistics for the players in each seat, and the
+        # running average of each seat being a spy for this game only.
+        self.rows = [self.global_statistics.fetch(p.name) for p in players]
+        # Chances of being one of the two spies out of the other four are 50%.
+        self.totals = [0.5] * len(players)
+        self.samples = [1.0] * len(players)
 
     def select(self, players, count):
         # TODO: The probability of each player depends on the team chosen.
@@ -203,7 +343,11 @@ class Statistician(Bot):
         return bool(total <= alternate)
 
     def _estimate(self, player):
-        return self.local_statistics[player.name].probability.estimate()
+        return self.totals[player.index-1] / self.samples[player.index-1]
+
+    def _update(self, player, probability):
+        self.totals[player.index-1] += probability
+        self.samples[player.index-1] += 1.0
 
     def sabotage(self):
         return self.spy
@@ -218,11 +362,11 @@ class Statistician(Bot):
         others = [p for p in self.game.team if p != self]
         probability = float(sabotaged) / float(len(others))
         for p in others:
-            self.local_statistics[p.name].update(probability)
+            self._update(p, probability)
 
         probability = 1.0 - float(sabotaged) / float(4 - len(others))
         for p in [p for p in self.players if p not in self.game.team]:
-            self.local_statistics[p.name].update(probability)
+            self._update(p, probability)
     
     def onVoteComplete(self, votes):
         # Step 2) Store.
@@ -231,68 +375,37 @@ class Statistician(Bot):
         # Based on the voting, we can do many things:
         #   - Infer the probability of spies being on the team.
         #   - Infer the probability of spies being the voters.
+        # TODO: If we had more information we could determine if a team
+        # excluded spies for sure, and run more accurate predictions.
 
         # Step 1) As resistance, run a bunch of predictions.
         # According to Bayes' Theorem:
         #   P(A|B) = P(B|A)  * P(A) / P(B)
         spied = bool(len([p for p in self.game.team if p in self.spies]) > 0)
-                # or self._discard(team)
         if spied:
             for player, vote in zip(self.game.players, votes):
-                p = self.local_statistics[player.name].probability.estimate()
+                p = self._estimate(player)
+                row = self.rows[player.index-1]
 
                 # In this case with:
                 #   - A is the probability of 'player' being a spy. 
                 #   - B is the probability of 'player' voting for suspects.
                 if vote:
-                    spy_Vote = self.fetch(player, ['spy_VotesForSpy'])
-                    probability = spy_Vote * p # / 1.0 
-                else:
-                    res_Vote = self.fetch(player, ['res_VotesForSpy'])
-                    probability = 1.0 - res_Vote * p # / 1.0 
-
-                self.local_statistics[player.name].update(probability)
-        elif False:
-            # TODO: If we had more information we could determine if a team excluded spies
-            # for sure!  In this case, we could run more accurate predictions...
-            for player, vote in zip(self.game.players, votes):
-                spy_Vote = self.fetch(player, ['spy_VotesForSpy', 'spy_VotesForRes'])
-                res_Vote = self.fetch(player, ['res_VotesForSpy', 'res_VotesForRes'])
-                p = self.local_statistics[player.name].probability.estimate()
-
-                # In this case with:
-                #   - A is the probability of 'player' being a spy. 
-                #   - B is the probability of 'player' voting true.
-                if vote:
+                    spy_Vote = self.global_statistics.estimate(row, SPY_VOTES_FOR_SPY)
                     probability = spy_Vote * p # / 1.0 
                 else:
+                    res_Vote = self.global_statistics.estimate(row, RES_VOTES_FOR_SPY)
                     probability = 1.0 - res_Vote * p # / 1.0 
 
-                self.local_statistics[player.name].update(probability)
-
-        for player, vote in zip(self.game.players, votes):
-            p = self.local_statistics[player.name].probability.estimate()
-            spy_Vote = self.fetch(player, ['spy_VotesForSpy']) * (0.0 + p) \
-                     + self.fetch(player, ['res_VotesForSpy']) * (1.0 - p)
-            res_Vote = self.fetch(player, ['spy_VotesForRes']) * (0.0 + p) \
-                     + self.fetch(player, ['res_VotesForRes']) * (1.0 - p)
-
-            for member in self.game.team:
-                # In this case, Bayes' Theorem with:
-                #   - A is the probability of team 'member' being a spy.
-                #   - B is the probability of 'player' voting true.
-                t = self.local_statistics[member.name].probability.estimate()
-                
-                if vote:
-                    probability = spy_Vote * t # / 1.0
-                else:
-                    probability = 1.0 - res_Vote * t # / 1.0
-
-                # NOTE: Reduces overall estimate quality...
-                # self.local_statistics[member.name].update(probability)
-
+                self._update(player, probability)
 
     def onGameComplete(self, win, spies):
+        seats, columns, values = [], [], []
+        def store(player, column, value):
+            seats.append(player.index-1)
+            columns.append(column)
+            values.append(value)
+
         for team, sabotaged in self.missions:
             suspects = [p for p in team if p in spies]
             # No spies on this mission to update statistics.
@@ -301,37 +414,31 @@ class Statistician(Bot):
 
             # This mission passed despite spies, very suspicious...
             for p in suspects:
-                self.store(p, 'spy_Sabotage', float(sabotaged) / float(len(suspects)))
+                store(p, SPY_SABOTAGE, float(sabotaged) / float(len(suspects)))
 
         for leader, team in self.selections:
             suspects = [p for p in team if p in spies]
             if leader in spies:
-                self.store(leader, 'spy_PicksSpy', int(len(suspects) > 0))
-                self.store(leader, 'spy_PicksSelf', int(leader in team))
+                store(leader, SPY_PICKS_SPY, int(len(suspects) > 0))
+                store(leader, SPY_PICKS_SELF, int(leader in team))
             else:
-                self.store(leader, 'res_PicksSpy', int(len(suspects) > 0))
-                self.store(leader, 'res_PicksSelf', int(leader in team))
+                store(leader, RES_PICKS_SPY, int(len(suspects) > 0))
+                store(leader, RES_PICKS_SELF, int(leader in team))
 
+        # Votes are stored for all seats at once, by whether there were spies
+        # on the team and whether each voter is a known spy.
+        known = [p in self.spies for p in self.game.players]
         for votes, team in self.votes:
             spied = len([p for p in team if p in spies]) > 0
-            for p, v in zip(self.game.players, votes):
-                if spied:
-                    if p in self.spies:
-                        self.store(p, 'spy_VotesForSpy', int(v))
-                    else:
-                        self.store(p, 'res_VotesForSpy', int(v))
-                else:
-                    if p in self.spies:
-                        self.store(p, 'spy_VotesForRes', int(v))
-                    else:
-                        self.store(p, 'res_VotesForRes', int(v))
-
-    def store(self, player, attribute, value):
-        self.global_statistics[player.name].__dict__[attribute].sample(value)
+            if spied:
+                columns.extend([SPY_VOTES_FOR_SPY if k else RES_VOTES_FOR_SPY for k in known])
+            else:
+                columns.extend([SPY_VOTES_FOR_RES if k else RES_VOTES_FOR_RES for k in known])
+            seats.extend(range(len(votes)))
+            values.extend([int(v) for v in votes])
 
-    def fetch(self, player, attributes):
-        result = 0.0
-        for a in attributes:
-            result += self.global_statistics[player.name].__dict__[a].estimate()
-        return result / float(len(attributes))
+        self.global_statistics.sample([self.rows[s] for s in seats], columns, values)
 
+        Statistician.games += 1
+        if Statistician.games % self.SAVE_GAMES == 0:
+            self.save()
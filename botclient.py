@@ -0,0 +1,345 @@
+"""Plays games over IRC for the bots a client hosts, whatever the client's
+networking.  client.py runs it with Twisted and geventclient.py with gevent,
+each passing a connection with msg, join, part and a nickname, and handing
+over the messages received."""
+
+import time
+import logging
+import threading
+
+from player import Player
+from game import State
+
+import codec
+
+
+# Least important level of the bots' log messages sent as comments.
+VERBOSITY = logging.DEBUG
+
+# Lines of comments sent per second at most, with bursts of up to BURST.
+# Comments over this budget are dropped, and only their number is sent.
+COMMENTS = 2.0
+BURST = 5
+
+# Longest line of comments sent, which are joined by ' | ' until then.
+COMMENT_LENGTH = 400
+
+
+def parseComments(setting):
+    """Settings of a ResistanceLogger given as level:rate, level:filename or
+    off, e.g. info:0.5 or debug:logs/comments.txt."""
+    if setting == 'off':
+        return False
+    level, _, destination = setting.partition(':')
+    comments = {'level': getattr(logging, level.upper())}
+    if destination.replace('.', '').isdigit():
+        comments['rate'] = float(destination)
+    elif destination:
+        comments['filename'] = destination
+    return comments
+
+
+class ResistanceLogger(logging.Handler):
+    """Sends the bots' log messages as comments in their games.  They're
+    kept separately for each game until the bot next replies, so comments
+    never hold up a reply, then sent on as few lines as possible.  They can
+    also be written to a file instead, prefixed by the game channel."""
+
+    def __init__(self, client, level = VERBOSITY, rate = COMMENTS, filename = None):
+        logging.Handler.__init__(self, level)
+        self.client = client
+        self.rate = rate
+        self.tokens = float(BURST)
+        self.last = time.time()
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.file = None
+        if filename:
+            self.file = open(filename, 'a')
+        # Comments not sent yet, by game channel.
+        self.pending = {}
+
+    def emit(self, record):
+        if self.client.channel is None:
+            return
+
+        try:
+            msg = self.format(record)
+            if self.file is not None:
+                self.file.write('%s %s\n' % (self.client.channel, msg))
+            else:
+                self.pending.setdefault(self.client.channel, []).append(msg)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        """Send the comments of the game being processed, if the rate allows."""
+        if self.file is not None:
+            self.file.flush()
+        comments = self.pending.pop(self.client.channel, None)
+        if not comments:
+            return
+
+        lines = [[]]
+        length = 0
+        for c in comments:
+            if lines[-1] and length + len(c) + 3 > COMMENT_LENGTH:
+                lines.append([])
+                length = 0
+            lines[-1].append(c)
+            length += len(c) + 3
+
+        for line in lines:
+            if not self._take():
+                self.dropped += len(line)
+                continue
+            if self.dropped:
+                line.append('(%i comments dropped)' % (self.dropped))
+                self.dropped = 0
+            self.client.send('COMMENT %s' % (codec.SEPARATOR.join(line)))
+
+    def discard(self, channel):
+        self.pending.pop(channel, None)
+
+    def _take(self):
+        if self.rate is None:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(float(BURST), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class Context(threading.local):
+    """Details of the message being processed, separately for each thread."""
+
+    channel = None
+    target = None
+    sender = None
+
+
+def contextual(name):
+    return property(lambda self: getattr(self.context, name),
+                    lambda self, value: setattr(self.context, name, value))
+
+
+class ResistanceClient(object):
+    """Plays games for the given bot classes.  If there are several, or the
+    only one isn't named like the connection, the client hosts them all and
+    works out which bot to create for each seat from the players revealed."""
+
+    def __init__(self, protocol, constructors, comments = None):
+        self.protocol = protocol
+        self.constructors = dict([(c.__name__, c) for c in constructors])
+        self.bots = {}
+        # Settings of the ResistanceLogger, or False to send no comments.
+        self.comments = {} if comments is None else comments
+        # Game and bot channels joined, to rejoin if the session is resumed,
+        # and how many messages were received for each game so far.
+        self.channels = set()
+        self.received = {}
+
+        # Name of the game channel being processed, which for multiplexed
+        # games is only a prefix of messages in the bot's private channel.
+        self.context = Context()
+        self.logger = None
+        self.logged = set()
+
+    channel = contextual('channel')
+    target = contextual('target')
+    sender = contextual('sender')
+
+    def connected(self):
+        self.protocol.join('#resistance')
+        hosts = ''
+        if self.constructors.keys() != [self.protocol.nickname]:
+            hosts = ' HOSTS %s' % (' '.join(sorted(self.constructors)))
+        self.protocol.msg('aigamedev', 'BOT MULTIPLEX BATCH%s' % (hosts))
+
+    def resumed(self, protocol):
+        """Carry on the games in progress over a new connection, after the
+        previous one was lost.  The moderator is told how many messages were
+        received for each game, so it sends again those that were lost and
+        asks again for any reply it's still waiting for."""
+        self.reattach(protocol)
+        self.connected()
+        for channel in sorted(self.channels):
+            self.protocol.join(channel)
+
+        pairs = ['%s %i' % (c, n) for c, n in sorted(self.received.items())]
+        lines = [' '.join(pairs[i:i+10]) for i in range(0, len(pairs), 10)] or ['']
+        for line in lines[:-1]:
+            self.protocol.msg('aigamedev', 'RESUMING %s' % (line))
+        self.protocol.msg('aigamedev', ('RESUME %s' % (lines[-1])).strip())
+
+    def reattach(self, protocol):
+        self.protocol = protocol
+
+    def join(self, channel):
+        self.channels.add(channel)
+        self.protocol.join(channel)
+
+    def part(self, channel):
+        self.channels.discard(channel)
+        self.protocol.part(channel)
+
+    def invited(self, channel):
+        if '#game-' in channel or channel == '#bot-%s' % (self.protocol.nickname):
+            self.join(channel)
+
+    def getBot(self):
+        return self.bots[self.channel]
+
+    def reply(self, message):
+        self.send(message)
+        # Comments are only sent once the bot has replied.
+        if self.logger:
+            self.logger.flush()
+
+    def send(self, message):
+        if self.target != self.channel:
+            message = '%s %s' % (self.channel, message)
+        self.protocol.msg(self.target, message)
+
+    def process_JOIN(self, msg):
+        channel = msg.rstrip('.').split(' ')[1]
+        self.join(channel)
+
+    def process_REVEAL(self, reveal, role, players, spies = None):
+        # PLAYERS 1-Deceiver, 2-Random, 3-Hippie;
+        participants = codec.parsePlayers(players)
+
+        # ROLE Resistance.
+        index = int(self.channel.split('-')[-1])
+        spy = bool(role.split(' ')[1] == 'Spy')
+        bot = self.constructors[participants[index-1].name](State(), index, spy)
+        if self.logger is None and self.comments is not False:
+            self.logger = ResistanceLogger(self, **self.comments)
+        if self.logger and bot.name not in self.logged:
+            self.logged.add(bot.name)
+            bot.log.addHandler(self.logger)
+            bot.log.setLevel(logging.DEBUG)
+
+        bot.recipient = self.sender
+        self.bots[self.channel] = bot
+        bot.game.players = participants
+
+        # SPIES 1-Deceiver.
+        saboteurs = set()
+        if spies:
+            saboteurs = self.makeTeam(spies, participants)
+            bot.game.spies = saboteurs
+
+        bot.onGameRevealed(participants, saboteurs)
+
+    def process_MISSION(self, mission, leader):
+        bot = self.getBot()
+
+        # MISSION 1.2;
+        state = bot.game
+        state.turn, state.tries = codec.parseMission(mission)
+
+        # LEADER 1-Random.
+        state.leader = codec.findPlayer(leader.split(' ', 1)[1], state.players)
+
+        bot.onMissionAttempt(state.turn, state.tries, state.leader)
+
+    def process_SELECT(self, select):
+        bot = self.getBot()
+        self.reply(codec.selected(bot.select(bot.game.players, codec.parseCount(select))))
+
+    def process_VOTE(self, team):
+        # VOTE 1-Random, 2-Hippie, 3-Paranoid.
+        bot = self.getBot()
+        bot.game.team = self.makeTeam(team, bot.game.players)
+        bot.onTeamSelected(bot.game.leader, bot.game.team)
+        self.reply(codec.voted(bot.vote(bot.game.team)))
+
+    def process_VOTES(self, votes):
+        bot = self.getBot()
+        bot.onVoteComplete(codec.parseVotes(votes))
+
+    def process_SABOTAGE(self, sabotage):
+        bot = self.getBot()
+        self.reply(codec.sabotaged(bot.spy and bot.sabotage()))
+
+    def process_SABOTAGES(self, sabotages):
+        bot = self.getBot()
+        sabotaged = codec.parseCount(sabotages)
+        if sabotaged == 0:
+            bot.game.wins += 1
+        else:
+            bot.game.losses += 1
+        bot.onMissionComplete(sabotaged)
+
+    def process_RESULT(self, result, spies):
+        bot = self.getBot()
+
+        w = codec.parseYesOrNo(result)
+        s = self.makeTeam(spies, bot.game.players)
+
+        bot.onGameComplete(w, s)
+        if self.logger:
+            self.logger.flush()
+        if self.target == self.channel:
+            self.part(self.channel)
+        self.bots.pop(self.channel, None)
+        self.received.pop(self.channel, None)
+
+    def process_QUERY(self, *args):
+        bot = self.getBot()
+        if 'SELECT' in args[0].upper():
+            selection = bot.select(bot.game.players, 3)
+            players = [Player(s.name, s.index) for s in selection]
+            self.reply("QUERY %s" % (players))
+
+    def makeTeam(self, team, players):
+        # VOTE 1-Random, 2-Hippie; with the first word skipped.
+        return set(codec.findPlayers(team.split(' ', 1)[1], players))
+
+    def message(self, sender, channel, msg):
+        target = channel
+        if channel.startswith('#bot-'):
+            channel, _, msg = msg.partition(' ')
+
+        # Batched messages are processed in order as if sent separately.
+        messages = msg.split(codec.SEPARATOR)
+        if '#game-' in channel:
+            self.received[channel] = self.received.get(channel, 0) + len(messages)
+        for m in messages:
+            self.process(sender, channel, target, m)
+
+    def process(self, sender, channel, target, msg):
+        cmd, args = codec.parse(msg)
+        if not hasattr(self, 'process_'+cmd):
+            return
+
+        process = getattr(self, 'process_'+cmd)
+        self.sender = sender
+        self.channel = channel
+        self.target = target
+
+        process(*args)
+
+        self.channel = None
+        self.target = None
+        self.sender = None
+
+    def disconnect(self, user, channel = None):
+        for ch, bot in list(self.bots.items()):
+            if user != bot.recipient:
+                continue
+            if channel and channel.startswith('#bot-'):
+                del self.bots[ch]
+            elif not channel or ch == channel:
+                self.part(ch)
+                del self.bots[ch]
+            self.received.pop(ch, None)
+            if self.logger:
+                self.logger.discard(ch)
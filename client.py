@@ -1,183 +1,64 @@
-import logging
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, defer, threads
+from twisted.protocols import basic
+from twisted.python import log
 
 from competition import getCompetitors
 from player import Player
 from game import State
+from botclient import ResistanceClient, parseComments
 
+import wire
 
-class ResistanceLogger(logging.Handler):
-
-    def __init__(self, protocol):
-        logging.Handler.__init__(self)
-        self.protocol = protocol
-        self.channel = None
-
-    def flush(self):
-        pass
-
-    def emit(self, record):
-        if self.channel is None:
-            return
-
-        try:
-            msg = self.format(record)
-            self.protocol.msg(self.channel, 'COMMENT %s' % (msg))
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
 
+class ReactorProxy(object):
+    """Sends commands for a protocol from other threads via the reactor."""
 
-class ResistanceClient(object):
-
-    def __init__(self, protocol, constructor):
+    def __init__(self, protocol):
         self.protocol = protocol
-        self.constructor = constructor
-        self.bots = {}
-
-        self.channel = None
-        self.logger = None
-        self.sender = None
-
-    def getBot(self):
-        return self.bots[self.channel]
-
-    def reply(self, message):
-        self.protocol.msg(self.channel, message)
-
-    def process_JOIN(self, msg):
-        channel = msg.rstrip('.').split(' ')[1]
-        self.protocol.join(channel)
-
-    def process_REVEAL(self, reveal, role, players, spies = None):
-        # ROLE Resistance.
-        index = self.channel.split('-')[-1]
-        spy = bool(role.split(' ')[1] == 'Spy')
-        bot = self.constructor(State(), int(index), spy)
-        if self.logger is None:
-            self.logger = ResistanceLogger(self.protocol)
-            bot.log.addHandler(self.logger)
-            bot.log.setLevel(logging.DEBUG)
-
-        bot.recipient = self.sender
-        self.bots[self.channel] = bot
-
-        # PLAYERS 1-Deceiver, 2-Random, 3-Hippie;
-        participants = []
-        for p in players.split(' ')[1:]:
-            participants.append(self.makePlayer(p.rstrip(',')))
-        bot.game.players = participants
-
-        # SPIES 1-Deceiver.
-        saboteurs = set()
-        if spies:
-            for s in spies.split(' ')[1:]:
-                saboteurs.add(self.makePlayer(s.rstrip(',')))
-            bot.game.spies = saboteurs
-
-        bot.onGameRevealed(participants, saboteurs)
-
-    def process_MISSION(self, mission, leader):
-        bot = self.getBot()
-
-        # MISSION #game-0002 1.2;
-        details = mission.split(' ')[1]
-        state = bot.game
-        state.turn, state.tries = [int(i) for i in details.split('.')]
-
-        # LEADER 1-Random.
-        state.leader = self.makePlayer(leader.split(' ')[1])
-
-        bot.onMissionAttempt(state.turn, state.tries, state.leader)
-
-    def process_SELECT(self, select):
-        count = select.split(' ')[1]
-        bot = self.getBot()
-        players = bot.game.players
-        selection = sorted(bot.select(players, int(count)), key = lambda p: p.index)
-        self.reply('SELECTED %s.' % (', '.join([str(Player(s.name, s.index)) for s in selection])))
-
-    def process_VOTE(self, team):
-        # VOTE 1-Random, 2-Hippie, 3-Paranoid.
-        bot = self.getBot()
-        bot.game.team = self.makeTeam(team)
-        bot.onTeamSelected(bot.game.leader, bot.game.team)
-        result = bot.vote(bot.game.team)
-        reply = {True: "Yes", False: "No"}
-        self.reply('VOTED %s.' % (reply[result]))
-
-    def process_VOTES(self, votes):
-        bot = self.getBot()
-        v = [bool(b.strip(',.') == 'Yes') for b in votes.split(' ')[1:]]
-        bot.onVoteComplete(v)
-
-    def process_SABOTAGE(self, sabotage):
-        bot = self.getBot()
-        result = bot.spy and bot.sabotage()
-        reply = {True: "Yes", False: "No"}
-        self.reply('SABOTAGED %s.' % (reply[result]))
-
-    def process_SABOTAGES(self, sabotages):
-        bot = self.getBot()
-        sabotaged = int(sabotages.split(' ')[1])
-        if sabotaged == 0:
-            bot.game.wins += 1
-        else:
-            bot.game.losses += 1
-        bot.onMissionComplete(sabotaged)
-
-    def process_RESULT(self, result, spies):
-        bot = self.getBot()
 
-        w = bool(result.split(' ')[1] == 'Yes')
-        s = self.makeTeam(spies)
+    @property
+    def nickname(self):
+        return self.protocol.nickname
 
-        bot.onGameComplete(w, s)
-        self.protocol.part(self.channel)
-        del self.bots[self.channel]
+    def msg(self, *args):
+        reactor.callFromThread(self.protocol.msg, *args)
 
-    def process_QUERY(self, *args):
-        bot = self.getBot()
-        if 'SELECT' in args[0].upper():
-            selection = bot.select(bot.game.players, 3)
-            players = [Player(s.name, s.index) for s in selection]
-            self.reply("QUERY %s" % (players))
+    def join(self, *args):
+        reactor.callFromThread(self.protocol.join, *args)
 
-    def makeTeam(self, team):
-        return set([self.makePlayer(t.strip('., ')) for t in team.split(' ')[1:]])
+    def part(self, *args):
+        reactor.callFromThread(self.protocol.part, *args)
 
-    def makePlayer(self, identifier):
-        index, name = identifier.split('-')
-        return Player(name, int(index))
 
-    def message(self, sender, channel, msg):
-        cmd = msg.split(' ')[0].rstrip('?!.')
-        if not hasattr(self, 'process_'+cmd):
-            return
+class ThreadedResistanceClient(ResistanceClient):
+    """Processes messages on the reactor's thread pool, so a bot that's slow
+    to decide in one game doesn't hold up all the others.  Messages for the
+    same game are still processed one after the other, in order.  Bots that
+    share state between instances must then be thread-safe."""
 
-        process = getattr(self, 'process_'+cmd)
-        args = [i.strip(' ') for i in msg.rstrip('.?!').split(';')]
-        self.sender = sender
-        self.channel = channel
-        if self.logger is not None:
-            self.logger.channel = channel
+    def __init__(self, protocol, constructors, comments = None):
+        ResistanceClient.__init__(self, ReactorProxy(protocol), constructors, comments)
+        # Deferred processing and count of queued messages, by game.
+        self.games = {}
 
-        process(*args)
+    def reattach(self, protocol):
+        self.protocol.protocol = protocol
 
-        if self.logger is not None:
-            self.logger.channel = None
-        self.channel = None
-        self.sender = None
+    def process(self, sender, channel, target, msg):
+        if channel not in self.games:
+            self.games[channel] = [defer.succeed(None), 0]
+        game = self.games[channel]
+        game[1] += 1
+        game[0].addCallback(lambda _: threads.deferToThread(ResistanceClient.process, self, sender, channel, target, msg))
+        game[0].addErrback(log.err)
+        game[0].addBoth(self.processed, channel)
 
-    def disconnect(self, user, channel = None):
-        for ch, bot in list(self.bots.items()):
-            if user != bot.recipient:
-                continue
-            if not channel or ch == channel:
-                self.protocol.part(ch)
-                del self.bots[ch]
+    def processed(self, result, channel):
+        game = self.games[channel]
+        game[1] -= 1
+        if game[1] == 0:
+            del self.games[channel]
 
 
 class ResistanceProtocol(irc.IRCClient):
@@ -188,9 +69,18 @@ class ResistanceProtocol(irc.IRCClient):
 
     def signedOn(self):
         print "CONNECTED %s" % (self.nickname)
-        self.client = ResistanceClient(self, self.factory.constructor)
-        self.join('#resistance')
-        self.msg('aigamedev', 'BOT')
+        # Bots keep their games going after reconnecting.
+        if self.factory.client is not None:
+            self.client = self.factory.client
+            self.client.resumed(self)
+            return
+
+        if self.factory.threads:
+            self.client = ThreadedResistanceClient(self, self.factory.constructors, self.factory.comments)
+        else:
+            self.client = ResistanceClient(self, self.factory.constructors, self.factory.comments)
+        self.factory.client = self.client
+        self.client.connected()
 
     def joined(self, channel):
         pass
@@ -206,18 +96,19 @@ class ResistanceProtocol(irc.IRCClient):
         self.client.disconnect(user)
 
     def irc_INVITE(self, user, args):
-        channel = args[1]
-        if '#game-' in channel:
-            self.join(channel) 
+        self.client.invited(args[1])
 
 
 class ResistanceFactory(protocol.ClientFactory):
 
     protocol = ResistanceProtocol
 
-    def __init__(self, bot):
-        self.constructor = bot
-        self.nickname = bot.__name__
+    def __init__(self, bots, nickname = None, threads = 0, comments = None):
+        self.constructors = bots
+        self.nickname = nickname or bots[0].__name__
+        self.threads = threads
+        self.comments = comments
+        self.client = None
 
     def clientConnectionLost(self, connector, reason):        
         print 'Connection lost.', reason
@@ -228,19 +119,125 @@ class ResistanceFactory(protocol.ClientFactory):
         reactor.stop()
 
 
+class BinaryResistanceProtocol(basic.Int16StringReceiver):
+    """Plays games for bots using the binary protocol from wire.py, with
+    one bot instance per game and seat."""
+
+    def connectionMade(self):
+        # Replies for many seats are small and shouldn't wait for each other.
+        if hasattr(self.transport, 'setTcpNoDelay'):
+            self.transport.setTcpNoDelay(True)
+        self.bots = {}
+        self.constructors = dict([(c.__name__, c) for c in self.factory.constructors])
+        self.sendString(wire.pack(wire.HELLO, 0, 0) + ' '.join(sorted(self.constructors)))
+
+    def reply(self, game, seat, opcode, *values):
+        self.sendString(wire.pack(opcode, game, seat, *values))
+
+    def stringReceived(self, data):
+        opcode, game, seat, payload = wire.unpack(data)
+        if opcode == wire.REVEAL:
+            names = wire.unpackNames(payload[2:])
+            self.bots[(game, seat)] = self.constructors[names[seat-1]](State(), seat, bool(ord(payload[0])))
+        bot = self.bots.get((game, seat))
+        if bot is None:
+            return
+
+        state = bot.game
+        if opcode == wire.REVEAL:
+            state.players = [Player(n, i+1) for i, n in enumerate(names)]
+            spies = set(wire.unmask(ord(payload[1]), state.players))
+            if spies:
+                state.spies = spies
+            bot.onGameRevealed(state.players, spies)
+
+        elif opcode == wire.MISSION:
+            state.turn, state.tries, leader = [ord(c) for c in payload[:3]]
+            state.leader = state.players[leader-1]
+            bot.onMissionAttempt(state.turn, state.tries, state.leader)
+
+        elif opcode == wire.SELECT:
+            selection = bot.select(state.players, ord(payload[0]))
+            self.reply(game, seat, wire.SELECTED, wire.mask(selection))
+
+        elif opcode == wire.VOTE:
+            state.team = set(wire.unmask(ord(payload[0]), state.players))
+            bot.onTeamSelected(state.leader, state.team)
+            self.reply(game, seat, wire.VOTED, int(bot.vote(state.team)))
+
+        elif opcode == wire.VOTES:
+            votes = ord(payload[0])
+            bot.onVoteComplete([bool(votes & (1 << i)) for i in range(len(state.players))])
+
+        elif opcode == wire.SABOTAGE:
+            self.reply(game, seat, wire.SABOTAGED, int(bot.spy and bot.sabotage()))
+
+        elif opcode == wire.SABOTAGES:
+            sabotaged = ord(payload[0])
+            if sabotaged == 0:
+                state.wins += 1
+            else:
+                state.losses += 1
+            bot.onMissionComplete(sabotaged)
+
+        elif opcode == wire.RESULT:
+            bot.onGameComplete(bool(ord(payload[0])), set(wire.unmask(ord(payload[1]), state.players)))
+            del self.bots[(game, seat)]
+
+
+class BinaryResistanceFactory(ResistanceFactory):
+
+    protocol = BinaryResistanceProtocol
+
+
 if __name__ == '__main__':
     import importlib
     import sys
     
     if len(sys.argv) == 1:
-        print 'USAGE: client.py file.BotName [...]'
+        print 'USAGE: client.py [wire=localhost:6668] [host=Nickname] [threads=4] [comments=debug:2.0] file.BotName [...]'
         sys.exit(-1)
 
     server = 'localhost'
     if 'irc.' in sys.argv[1]:
         server = sys.argv.pop(1)
 
-    for cls in getCompetitors(sys.argv[1:]):
-        reactor.connectTCP(server, 6667, ResistanceFactory(cls))
+    # Bot-only competitions can use the binary protocol on a TCP or Unix socket.
+    address = None
+    if sys.argv[1].startswith('wire='):
+        address = sys.argv.pop(1).split('=', 1)[1]
+
+    # All the bots can be hosted by a single connection with the given name.
+    nickname = None
+    if sys.argv[1].startswith('host='):
+        nickname = sys.argv.pop(1).split('=', 1)[1]
+
+    # Games can be played on a pool of threads, for slow bots.
+    threads = 0
+    if sys.argv[1].startswith('threads='):
+        threads = int(sys.argv.pop(1).split('=', 1)[1])
+        reactor.suggestThreadPoolSize(threads)
+
+    # Bots' comments can be sent from the given level at some lines per second,
+    # e.g. comments=info:0.5 or comments=warning, written to a file instead
+    # with comments=debug:logs/comments.txt, or not sent with comments=off.
+    comments = None
+    if sys.argv[1].startswith('comments='):
+        comments = parseComments(sys.argv.pop(1).split('=', 1)[1])
+
+    competitors = getCompetitors(sys.argv[1:])
+    if nickname or address:
+        groups = [competitors]
+    else:
+        groups = [[cls] for cls in competitors]
+
+    for bots in groups:
+        if address is None:
+            reactor.connectTCP(server, 6667, ResistanceFactory(bots, nickname, threads, comments))
+        elif '/' in address:
+            reactor.connectUNIX(address, BinaryResistanceFactory(bots))
+        else:
+            host, port = address.split(':')
+            reactor.connectTCP(host, int(port), BinaryResistanceFactory(bots))
 
     reactor.run()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Text protocol between the moderator in server.py and the bots' clients in
+client.py, so both sides write and read messages the same way.  Players are
+written as 1-Name, and looked up by the index of their seat rather than by
+name.  Several messages may be batched on one line separated by ' | ', and
+each message has fields separated by ';'.  Run this module to check that all
+messages survive the round trip with random games, and to time the parsers."""
+
+import re
+
+from player import Player
+
+
+SEPARATOR = ' | '
+
+PLAYER = re.compile(r'(\d+)-([^\s,.;!?|]+)')
+WORDS = re.compile(r'[^\s,.;!?]+')
+INDEX = re.compile(r'\d+')
+VOTES = re.compile(r'Yes|No')
+MISSION = re.compile(r'(\d+)\.(\d+)')
+YES = re.compile(r'yes|true', re.IGNORECASE)
+NO = re.compile(r'no|false', re.IGNORECASE)
+
+
+def showYesOrNo(b):
+    return 'Yes' if b else 'No'
+
+def parseYesOrNo(text):
+    """True or False for replies typed by bots or humans, None otherwise."""
+    if NO.search(text):
+        return False
+    if YES.search(text):
+        return True
+    return None
+
+def showTeam(players):
+    return ', '.join(['%i-%s' % (p.index, p.name) for p in players])
+
+
+def parsePlayers(text):
+    """New players for all those named in the text, e.g. 1-Alice, 2-Bob."""
+    return [Player(name, int(index)) for index, name in PLAYER.findall(text)]
+
+def findPlayer(word, players):
+    """Player in the game from its index, or from its name as humans may type
+    only that.  Names may have digits in them, but only after a letter."""
+    if word[0].isdigit():
+        index = int(INDEX.match(word).group())
+        if 0 < index <= len(players):
+            return players[index-1]
+    for p in players:
+        if word == p.name:
+            return p
+    for p in players:
+        if word in p.name:
+            return p
+    raise ValueError("Can't find player for input name '%s'." % (word))
+
+def findPlayers(text, players):
+    """Players in the game for all those in the text, in order."""
+    return [findPlayer(w, players) for w in WORDS.findall(text)]
+
+
+def parse(msg):
+    """Command of a message and its fields, stripped of punctuation."""
+    return msg.split(' ', 1)[0].rstrip('?!.'), [f.strip(' ') for f in msg.rstrip('.?!').split(';')]
+
+def parseCount(text):
+    return int(INDEX.search(text).group())
+
+def parseMission(text):
+    """Mission and attempt numbers from e.g. MISSION 1.2."""
+    turn, tries = MISSION.search(text).groups()
+    return int(turn), int(tries)
+
+def parseVotes(text):
+    return [v == 'Yes' for v in VOTES.findall(text)]
+
+
+# Messages from the moderator to the bots.
+
+def reveal(game, spy, players, spies):
+    s = ''
+    if spy:
+        s = '; SPIES ' + showTeam(spies)
+    return 'REVEAL %s; ROLE %s; PLAYERS %s%s.' % (game, 'Spy' if spy else 'Resistance', showTeam(players), s)
+
+def mission(turn, tries, leader):
+    return 'MISSION %i.%i; LEADER %i-%s.' % (turn, tries, leader.index, leader.name)
+
+def select(count, again = False):
+    return 'SELECT %i%s' % (count, '?' if again else '!')
+
+def vote(team):
+    return 'VOTE %s?' % (showTeam(team))
+
+def votes(votes):
+    return 'VOTES %s.' % (', '.join([showYesOrNo(v) for v in votes]))
+
+def sabotage():
+    return 'SABOTAGE?'
+
+def sabotages(count):
+    return 'SABOTAGES %i.' % (count)
+
+def result(win, spies):
+    return 'RESULT %s; SPIES %s.' % (showYesOrNo(win), showTeam(spies))
+
+
+# Replies from the bots to the moderator.
+
+def selected(team):
+    return 'SELECTED %s.' % (showTeam(sorted(team, key = lambda p: p.index)))
+
+def voted(b):
+    return 'VOTED %s.' % (showYesOrNo(b))
+
+def sabotaged(b):
+    return 'SABOTAGED %s.' % (showYesOrNo(b))
+
+
+def fuzz(rounds):
+    """Check that random messages read back as they were written."""
+    import random
+    letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'
+    for i in range(rounds):
+        count = random.choice([5, 6, 7, 8, 9, 10])
+        players = []
+        for index in range(1, count+1):
+            # Any name the moderator accepts, starting with a letter.
+            name = random.choice(letters[:52]) + ''.join([random.choice(letters) for j in range(random.randint(0, 12))])
+            players.append(Player(name, index))
+        team = random.sample(players, random.randint(1, count))
+        spy = random.random() < 0.5
+        flags = [random.random() < 0.5 for p in players]
+
+        cmd, fields = parse(reveal('#game-%04i' % (i), spy, players, team))
+        assert cmd == 'REVEAL'
+        assert parsePlayers(fields[2]) == players
+        assert (fields[1] == 'ROLE Spy') == spy
+        assert not spy or findPlayers(fields[3].split(' ', 1)[1], players) == team
+
+        cmd, fields = parse(mission(3, 4, team[0]))
+        assert cmd == 'MISSION' and parseMission(fields[0]) == (3, 4)
+        assert findPlayers(fields[1].split(' ', 1)[1], players) == [team[0]]
+
+        cmd, fields = parse(select(len(team), random.random() < 0.5))
+        assert cmd == 'SELECT' and parseCount(fields[0]) == len(team)
+
+        cmd, fields = parse(vote(team))
+        assert cmd == 'VOTE' and findPlayers(fields[0].split(' ', 1)[1], players) == team
+
+        cmd, fields = parse(votes(flags))
+        assert cmd == 'VOTES' and parseVotes(fields[0]) == flags
+
+        cmd, fields = parse(result(flags[0], team))
+        assert cmd == 'RESULT' and parseYesOrNo(fields[0]) == flags[0]
+        assert findPlayers(fields[1].split(' ', 1)[1], players) == team
+
+        cmd, fields = parse(selected(team))
+        assert cmd == 'SELECTED'
+        assert findPlayers(fields[0].split(' ', 1)[1], players) == sorted(team, key = lambda p: p.index)
+        assert parseYesOrNo(voted(flags[0]).split(' ', 1)[1]) == flags[0]
+        assert parseYesOrNo(sabotaged(flags[0]).split(' ', 1)[1]) == flags[0]
+
+
+def benchmark(rounds):
+    """Time reading all the messages of a typical mission."""
+    import time
+    players = [Player(n, i+1) for i, n in enumerate(['Deceiver', 'RandomBot', 'Hippie', 'Paranoid', 'RuleFollower'])]
+    team = lambda text: findPlayers(text.split(' ', 1)[1], players)
+    messages = [
+        (mission(2, 1, players[3]),                 lambda f: (parseMission(f[0]), team(f[1]))),
+        (select(3),                                 lambda f: parseCount(f[0])),
+        (selected(players[:3]),                     lambda f: team(f[0])),
+        (vote(players[:3]),                         lambda f: team(f[0])),
+        (voted(True),                               lambda f: parseYesOrNo(f[0])),
+        (votes([True, False, True, True, False]),   lambda f: parseVotes(f[0])),
+        (sabotaged(False),                          lambda f: parseYesOrNo(f[0])),
+        (sabotages(1),                              lambda f: parseCount(f[0])),
+        (result(False, players[:2]),                lambda f: (parseYesOrNo(f[0]), team(f[1]))),
+    ]
+
+    t = time.time()
+    for i in range(rounds):
+        for m, read in messages:
+            cmd, fields = parse(m)
+            read(fields)
+    seconds = time.time() - t
+    count = rounds * len(messages)
+    print 'CODEC %i messages in %0.2fs, %0.1f per second.' % (count, seconds, count / seconds)
+
+
+if __name__ == '__main__':
+    import sys
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    fuzz(rounds)
+    print 'FUZZ %i random games read back as written.' % (rounds)
+    benchmark(rounds)
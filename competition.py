@@ -26,11 +26,39 @@ class CompetitionStatistics:
             self.resWins.samples + self.spyWins.samples
             )
 
+    def merge(self, other):
+        for name, value in other.__dict__.items():
+            self.__dict__[name].merge(value)
+
+    def dump(self):
+        """Plain representation of the statistics, e.g. to send over a socket."""
+        return dict([(n, (v.total, v.samples)) for n, v in self.__dict__.items()])
+
+    @classmethod
+    def load(cls, data):
+        s = cls()
+        for name, (total, samples) in data.items():
+            s.__dict__[name] = Variable(total, samples)
+        return s
+
+
+def mergeStatistics(data):
+    """Accumulate statistics dumped by another runner into the global ones."""
+    for name, s in data.items():
+        statistics.setdefault(name, CompetitionStatistics())
+        statistics[name].merge(CompetitionStatistics.load(s))
+
 
 class CompetitionRound(Game):
+    """Game that keeps statistics about the bots playing it, which are added
+    to the global statistics once it's complete."""
+
+    def __init__(self, bots):
+        Game.__init__(self, bots)
+        self.statistics = {}
 
     def onPlayerVoted(self, player, vote, leader, team):
-        global statistics
+        statistics = self.statistics
         if player.spy:
             return
 
@@ -52,7 +80,7 @@ class CompetitionRound(Game):
             s.spyVoted.sample(int(vote))
    
     def onPlayerSelected(self, player, team):
-        global statistics
+        statistics = self.statistics
         if player.spy:
             return
 
@@ -69,10 +97,11 @@ class CompetitionRound(Game):
 
 class CompetitionRunner(object):
 
-    def __init__(self, competitors, rounds = 10000):
+    def __init__(self, competitors, rounds = 10000, seed = None):
         self.competitors = competitors
         self.rounds = rounds
-        self.games = [] 
+        self.seed = seed
+        self.games = set()
 
     def pickPlayersForRound(self):
         # Only one instance of each bot per game, assumes more than five.
@@ -81,32 +110,50 @@ class CompetitionRunner(object):
         # Multiple possible bot instances per game, works for any number.
         return [random.choice(self.competitors) for x in range(0,5)] 
 
-    def main(self):
+    def start(self):
         names = [bot.__name__ for bot in self.competitors]
         for bot in self.competitors:
             if hasattr(bot, 'onCompetitionStarting'):
                 bot.onCompetitionStarting(names)
 
-        for i in range(1,self.rounds+1):
+    def main(self):
+        self.start()
+        self.playRounds(1, self.rounds+1)
+
+    def playRounds(self, first, last):
+        """Play the rounds numbered [first, last).  With a seed, each round
+        is seeded separately so ranges can be played in any order or place."""
+        for i in xrange(first, last):
             if i % 2000 == 0: print >>sys.stderr, 'o'
             elif i % 50 == 0: print >>sys.stderr, '.',
 
+            if self.seed is not None:
+                random.seed(self.seed * 2**32 + i)
             self.play(CompetitionRound, self.pickPlayersForRound())
 
     def play(self, GameType, players, channel = None):
         g = GameType(players)
         g.channel = channel
-        self.games.append(g)
-        g.run()
-        self.games.remove(g)
-
+        self.games.add(g)
+        try:
+            g.run()
+        finally:
+            self.games.discard(g)
+
+        # Games that don't keep their own statistics count straight away.
+        results = getattr(g, 'statistics', statistics)
         for b in g.bots:
-            statistics.setdefault(b.name, CompetitionStatistics())
-            s = statistics.get(b.name)
+            results.setdefault(b.name, CompetitionStatistics())
+            s = results.get(b.name)
             if b.spy:
                 s.spyWins.sample(int(not g.won))
             else:
                 s.resWins.sample(int(g.won))
+
+        if results is not statistics:
+            for name, s in results.items():
+                statistics.setdefault(name, CompetitionStatistics())
+                statistics[name].merge(s)
         return g
 
     def echo(self, *args):
@@ -124,15 +171,15 @@ class CompetitionRunner(object):
             return
 
         self.echo("SPIES\t\t\t\t(voted,\t\tselected)")
-        for s in sorted(statistics.items(), key = lambda x: x[1].spyWins.estimate(), reverse = True):
+        for s in sorted(sorted(statistics.items()), key = lambda x: x[1].spyWins.estimate(), reverse = True):
             self.echo(" ", '{0:<16s}'.format(s[0]), s[1].spyWins, "\t", s[1].spyVoted, "\t", s[1].spySelected)
 
         self.echo("RESISTANCE\t\t\t(vote,\t\tselect)")
-        for s in sorted(statistics.items(), key = lambda x: x[1].resWins.estimate(), reverse = True):
+        for s in sorted(sorted(statistics.items()), key = lambda x: x[1].resWins.estimate(), reverse = True):
             self.echo(" ", '{0:<16s}'.format(s[0]), s[1].resWins, "\t", s[1].votesRes, s[1].votesSpy, "\t", s[1].selections)
 
         self.echo("TOTAL")
-        for s in sorted(statistics.items(), key = lambda x: x[1].total().estimate(), reverse = True):
+        for s in sorted(sorted(statistics.items()), key = lambda x: x[1].total().estimate(), reverse = True):
             self.echo(" ", '{0:<16s}'.format(s[0]), s[1].total())
         self.echo("")
 
@@ -160,11 +207,15 @@ def getCompetitors(argv):
 
 if __name__ == '__main__':
     if len(sys.argv) <= 2:
-        print 'USAGE: competition.py 10000 file.BotName [...]'
+        print 'USAGE: competition.py 10000 [seed=42] file.BotName [...]'
         sys.exit(-1)
 
+    seed = None
+    if sys.argv[2].startswith('seed='):
+        seed = int(sys.argv.pop(2).split('=')[1])
+
     competitors = getCompetitors(sys.argv[2:])
-    runner = CompetitionRunner(competitors, int(sys.argv[1]))
+    runner = CompetitionRunner(competitors, int(sys.argv[1]), seed)
     try:
         runner.main()
     except (KeyboardInterrupt, SystemExit):
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Spread a competition over multiple processes or machines.  A coordinator
+hands out ranges of seeded rounds over TCP, and workers play them using a
+CompetitionRunner then send back the statistics so they can be merged.  As all
+rounds are seeded individually, the final output matches a single-node run of
+competition.py with the same seed (for bots that don't learn across games)."""
+
+import sys
+import json
+import socket
+import threading
+import subprocess
+import SocketServer
+import Queue
+
+import competition
+from competition import CompetitionRunner, getCompetitors
+
+
+# Seconds a worker is given to play a range of rounds before it's given up
+# on, and the range is handed to another worker.
+TIMEOUT = 600.0
+
+
+def send(stream, data):
+    stream.write(json.dumps(data) + '\n')
+    stream.flush()
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise socket.error("Connection closed by peer.")
+    return json.loads(line)
+
+
+class WorkerHandler(SocketServer.StreamRequestHandler):
+    """Serves ranges of rounds to a single connected worker until there are
+    none left.  If the worker is lost, or takes too long to play its range,
+    the range is put back."""
+
+    def handle(self):
+        c = self.server.coordinator
+        self.request.settimeout(c.timeout)
+        send(self.wfile, {'competitors': c.specs, 'seed': c.seed})
+
+        while not c.finished.is_set():
+            try:
+                rounds = c.pending.get(timeout = 0.5)
+            except Queue.Empty:
+                continue
+
+            try:
+                send(self.wfile, {'rounds': rounds})
+                reply = receive(self.rfile)
+            except (socket.error, ValueError):
+                c.pending.put(rounds)
+                return
+            c.complete(tuple(reply['rounds']), reply['statistics'])
+
+        try:
+            send(self.wfile, {'done': True})
+        except socket.error:
+            pass
+
+
+class Coordinator(object):
+
+    def __init__(self, specs, rounds, seed, port, chunk = 500, timeout = TIMEOUT):
+        self.specs = specs
+        self.seed = seed
+        self.timeout = timeout
+        self.runner = CompetitionRunner(getCompetitors(specs), rounds, seed)
+
+        self.pending = Queue.Queue()
+        self.remaining = set()
+        for first in range(1, rounds+1, chunk):
+            r = (first, min(first + chunk, rounds+1))
+            self.remaining.add(r)
+            self.pending.put(r)
+
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        if not self.remaining:
+            self.finished.set()
+
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        self.server = SocketServer.ThreadingTCPServer(('', port), WorkerHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+
+    def complete(self, rounds, statistics):
+        with self.lock:
+            # Only count each range once, in case it was played again.
+            if rounds not in self.remaining:
+                return
+            self.remaining.remove(rounds)
+            competition.mergeStatistics(statistics)
+            print >>sys.stderr, '.',
+            if not self.remaining:
+                self.finished.set()
+
+    def main(self):
+        self.runner.start()
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        while not self.finished.wait(1.0):
+            pass
+        self.server.shutdown()
+
+    def show(self):
+        self.runner.show()
+
+
+class Worker(object):
+
+    def __init__(self, address):
+        host, port = address.split(':')
+        self.socket = socket.create_connection((host, int(port)))
+        self.stream = self.socket.makefile('rw')
+
+    def main(self):
+        setup = receive(self.stream)
+        runner = CompetitionRunner(getCompetitors(setup['competitors']), 0, setup['seed'])
+        runner.start()
+
+        while True:
+            request = receive(self.stream)
+            if 'done' in request:
+                break
+
+            competition.statistics = {}
+            runner.playRounds(*request['rounds'])
+            statistics = dict([(n, s.dump()) for n, s in competition.statistics.items()])
+            send(self.stream, {'rounds': request['rounds'], 'statistics': statistics})
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'worker':
+        workers = [subprocess.Popen([sys.executable, __file__, 'worker', sys.argv[2]])
+                   for i in range(1, int(sys.argv[3]) if len(sys.argv) > 3 else 1)]
+        try:
+            Worker(sys.argv[2]).main()
+        finally:
+            for w in workers:
+                w.wait()
+
+    elif len(sys.argv) > 5 and sys.argv[1] == 'coordinator':
+        coordinator = Coordinator(sys.argv[5:], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[2]))
+        try:
+            coordinator.main()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            coordinator.show()
+
+    else:
+        print 'USAGE: distributed.py coordinator 6000 10000 42 file.BotName [...]'
+        print '       distributed.py worker localhost:6000 [4]'
+        sys.exit(-1)
@@ -36,6 +36,26 @@ class Game:
    
     def onPlayerSelected(self, player, team):
         pass
+
+    # Internal callbacks with the same information the bots get, e.g. for
+    # observers of the game.  Spies are always revealed.
+    def onGameRevealed(self, players, spies):
+        pass
+
+    def onMissionAttempt(self, mission, tries, leader):
+        pass
+
+    def onTeamSelected(self, leader, team):
+        pass
+
+    def onVoteComplete(self, votes):
+        pass
+
+    def onMissionComplete(self, sabotaged):
+        pass
+
+    def onGameComplete(self, win, spies):
+        pass
    
     def __init__(self, bots):
         self.state = State()        
@@ -68,6 +88,7 @@ class Game:
                 p.onGameRevealed(self.state.players, spies)
             else:
                 p.onGameRevealed(self.state.players, set())
+        self.onGameRevealed(self.state.players, spies)
 
         # Repeat as long as the game hasn't hit the max number of missions.
         while self.state.turn <= self.NUM_TURNS:
@@ -93,6 +114,7 @@ class Game:
         # Pass back the results to the bots so they can do some learning!
         for p in self.bots:
             p.onGameComplete(self.state.wins >= self.NUM_WINS, spies)
+        self.onGameComplete(self.state.wins >= self.NUM_WINS, spies)
 
     @property
     def won(self):
@@ -112,6 +134,7 @@ class Game:
         l = self.bots[self.state.leader.index-1]
         for p in self.bots:
             p.onMissionAttempt(self.state.turn, self.state.tries, self.state.leader)
+        self.onMissionAttempt(self.state.turn, self.state.tries, self.state.leader)
 
         count = self.participants[self.state.turn-1]
         selected = l.select(self.state.players, count)
@@ -128,6 +151,7 @@ class Game:
         self.state.team = set(selected)
         for p in self.bots:
             p.onTeamSelected(self.state.leader, selected)
+        self.onTeamSelected(self.state.leader, selected)
 
         # Step 2) Notify other bots of the selection and ask for a vote.
         votes = []
@@ -143,6 +167,7 @@ class Game:
         # Step 3) Notify players of the vote result.
         for p in self.bots:
             p.onVoteComplete(votes[:])
+        self.onVoteComplete(votes[:])
 
         # Bail out if there was no clear majority...
         if score <= 2:
@@ -173,6 +198,7 @@ class Game:
         # passed back safely without divulging Spy/Resistance identities.
         for p in [b for b in self.bots if b not in selected]:
             p.onMissionComplete(sabotaged)
+        self.onMissionComplete(sabotaged)
 
         return True
 
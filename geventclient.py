@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Lightweight alternative to client.py that plays over IRC with gevent
+instead of Twisted, for hosting many bots at once.  Each connection is a
+greenlet that reads raw IRC lines and hands them to the ResistanceClient from
+botclient.py, like client.py does, so it works with server.py as it is and
+doesn't need Twisted.  Connections that are lost reconnect and resume their
+games."""
+
+import sys
+
+import gevent
+from gevent import socket
+
+from competition import getCompetitors
+from botclient import ResistanceClient, parseComments
+
+
+# Seconds to wait before connecting again after losing the connection.
+RECONNECT = 5.0
+
+
+class IrcConnection(object):
+    """Connection to the IRC server for a ResistanceClient hosting bots,
+    providing the commands it expects from its protocol."""
+
+    def __init__(self, address, constructors, nickname = None, comments = None):
+        self.address = address
+        self.nick = nickname or constructors[0].__name__
+        self.client = ResistanceClient(self, constructors, comments)
+        self.socket = None
+        self.started = False
+
+    @property
+    def nickname(self):
+        return self.nick
+
+    def send(self, line):
+        self.socket.sendall(line + '\r\n')
+
+    def msg(self, target, text):
+        self.send('PRIVMSG %s :%s' % (target, text))
+
+    def join(self, channel):
+        self.send('JOIN %s' % (channel))
+
+    def part(self, channel):
+        self.send('PART %s' % (channel))
+
+    def run(self):
+        while True:
+            try:
+                self.socket = socket.create_connection(self.address)
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.send('NICK %s' % (self.nick))
+                self.send('USER %s 0 * :%s' % (self.nick, self.nick))
+                stream = self.socket.makefile('rb')
+                for line in stream:
+                    self.receive(line.rstrip('\r\n'))
+                print 'Connection lost.'
+            except socket.error, e:
+                print 'Connection failed.', e
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            gevent.sleep(RECONNECT)
+
+    def receive(self, line):
+        prefix = ''
+        if line.startswith(':'):
+            prefix, _, line = line[1:].partition(' ')
+        line, _, text = line.partition(' :')
+        params = line.split(' ')
+        command, params = params[0], params[1:]
+        user = prefix.split('!')[0]
+
+        if command == 'PING':
+            self.send('PONG :%s' % (text or ' '.join(params)))
+        elif command == '001':
+            print "CONNECTED %s" % (self.nick)
+            if self.started:
+                self.client.resumed(self)
+            else:
+                self.started = True
+                self.client.connected()
+        elif command == 'PRIVMSG':
+            self.client.message(user, params[0], text)
+        elif command == 'PART' and user != self.nick:
+            self.client.disconnect(user, (params + [text])[0])
+        elif command == 'QUIT':
+            self.client.disconnect(user)
+        elif command == 'INVITE':
+            self.client.invited((params + [text])[1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print 'USAGE: geventclient.py [irc.server[:6667]] [host=Nickname] [comments=debug:2.0] file.BotName [...]'
+        sys.exit(-1)
+
+    address = ('localhost', 6667)
+    if 'irc.' in sys.argv[1]:
+        host, _, port = sys.argv.pop(1).partition(':')
+        address = (host, int(port or 6667))
+
+    # All the bots can be hosted by a single connection with the given name.
+    nickname = None
+    if sys.argv[1].startswith('host='):
+        nickname = sys.argv.pop(1).split('=', 1)[1]
+
+    comments = None
+    if sys.argv[1].startswith('comments='):
+        comments = parseComments(sys.argv.pop(1).split('=', 1)[1])
+
+    competitors = getCompetitors(sys.argv[1:])
+    if nickname:
+        groups = [competitors]
+    else:
+        groups = [[cls] for cls in competitors]
+
+    gevent.joinall([gevent.spawn(IrcConnection(address, bots, nickname, comments).run) for bots in groups])
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test for the moderator in server.py, run over the loopback from
+loopback.py so there's no IRC server involved.  Fake bots that pick moves at
+random after a configurable think time play at an increasing number of tables
+at once, each with its own PLAY request, and the throughput, reply latency and
+timeouts of the moderator are reported for each level."""
+
+import sys
+import time
+import random
+
+import gevent
+from gevent.event import Event
+
+import loopback
+import competition
+from player import Bot
+from server import ResistanceCompetitionHandler, Latency, TIMEOUTS
+
+
+# Distributions of think times, given the average in seconds.
+THINK = {
+    'none':         lambda m: 0.0,
+    'constant':     lambda m: m,
+    'uniform':      lambda m: random.uniform(0.0, 2.0 * m),
+    'exponential':  lambda m: random.expovariate(1.0 / m),
+}
+
+
+class LoadBot(Bot):
+    """Plays at random after thinking for a while.  The think time blocks the
+    whole client like a slow bot would with client.py."""
+
+    think = staticmethod(lambda: 0.0)
+
+    def select(self, players, count):
+        gevent.sleep(self.think())
+        return [self] + random.sample(self.others(), count - 1)
+
+    def vote(self, team):
+        gevent.sleep(self.think())
+        return random.random() < 0.7
+
+    def sabotage(self):
+        gevent.sleep(self.think())
+        return random.random() < 0.8
+
+
+class RecordingLatency(Latency):
+    """Keeps all the reply times seen by the moderator, for percentiles."""
+
+    def __init__(self, bounds, samples):
+        Latency.__init__(self, bounds)
+        self.samples = samples
+        self.total = 0
+
+    def sample(self, seconds):
+        Latency.sample(self, seconds)
+        self.samples.append(seconds)
+
+    def timeout(self):
+        Latency.timeout(self)
+        self.total += 1
+
+
+class LoadHandler(ResistanceCompetitionHandler):
+
+    def __init__(self, timeouts):
+        ResistanceCompetitionHandler.__init__(self, timeouts = timeouts)
+        self.samples = []
+
+    def latency(self, name):
+        if name not in self.latencies:
+            self.latencies[name] = RecordingLatency(self.timeouts, self.samples)
+        return self.latencies[name]
+
+    def show(self):
+        # Skip the competition report, and keep the statistics small.
+        competition.statistics = {}
+
+
+class Requester(loopback.Connection):
+    """Asks for games in #resistance and waits for them to be played."""
+
+    def __init__(self, lb, nick):
+        loopback.Connection.__init__(self, lb, nick)
+        self.finished = Event()
+
+    def connected(self):
+        self.join('#resistance')
+
+    def receive(self, msg):
+        if msg.command != 'PRIVMSG' or msg.params[0] != '#resistance':
+            return
+        if msg.text.startswith('PLAYED') or msg.text.startswith('TIMEOUT'):
+            self.finished.set()
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+def measure(tables, games, think, timeouts):
+    lb = loopback.Loopback()
+    handler = LoadHandler(timeouts)
+    lb.connect(loopback.ServerConnection(lb, 'aigamedev', handler))
+
+    requesters = []
+    for t in range(tables):
+        names = []
+        for i in range(5):
+            name = 'Load%02i%i' % (t, i)
+            bot = type(name, (LoadBot,), {'think': staticmethod(think)})
+            lb.connect(loopback.BotConnection(lb, [bot]))
+            names.append(bot.__name__)
+        r = Requester(lb, 'table%02i' % (t))
+        lb.connect(r)
+        requesters.append((r, names))
+    gevent.sleep(0.1)
+
+    start = time.time()
+    for r, names in requesters:
+        r.msg('#resistance', 'PLAY %i %s' % (games, ' '.join(names)))
+    for r, names in requesters:
+        r.finished.wait()
+    seconds = time.time() - start
+
+    samples = sorted(handler.samples)
+    timeouts = sum([l.total for l in handler.latencies.values()])
+    calls = len(samples) + timeouts
+    print '%6i %8.1f %8.1f %8.1f %8.1f %8i %7.2f%%' % (
+            tables, tables * games / seconds,
+            1000.0 * percentile(samples, 50), 1000.0 * percentile(samples, 90), 1000.0 * percentile(samples, 99),
+            int(handler.scheduler.limit), 100.0 * timeouts / max(calls, 1))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    # Settings are given as games=100, think=exponential:0.005,
+    # tables=1,2,4,8,16 and timeouts=0.25:5.0.
+    options = dict([a.split('=', 1) for a in sys.argv[1:] if '=' in a])
+    if len(options) != len(sys.argv) - 1:
+        print 'USAGE: loadtest.py [games=100] [think=exponential:0.005] [tables=1,2,4,8,16] [timeouts=0.25:5.0]'
+        sys.exit(-1)
+
+    games = int(options.get('games', 100))
+    distribution, _, average = options.get('think', 'exponential:0.005').partition(':')
+    # The average may be left out, e.g. think=none.
+    average = float(average or 0.005)
+    think = lambda: THINK[distribution](average)
+    tables = [int(t) for t in options.get('tables', '1,2,4,8,16').split(',')]
+    timeouts = TIMEOUTS
+    if 'timeouts' in options:
+        timeouts = tuple([float(t) for t in options['timeouts'].split(':')])
+
+    print 'TABLES      GPS   p50 ms   p90 ms   p99 ms    GAMES  TIMEOUTS'
+    for t in tables:
+        measure(t, games, think, timeouts)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""In-process stand-in for an IRC server, so that the moderator from server.py
+and bots hosted as in client.py can play full games in a single process, with
+no IRC daemon or network involved.  Only the JOIN, PART, INVITE, NAMES and
+PRIVMSG semantics that both sides rely on are emulated."""
+
+import sys
+import time
+import collections
+
+import gevent
+from gevent import Greenlet
+from gevent import queue
+from gevent.event import Event
+
+from competition import getCompetitors
+from botclient import ResistanceClient
+from server import ResistanceCompetitionHandler
+
+
+class Message(object):
+    """Incoming message, in the same form as geventirc provides them."""
+
+    def __init__(self, sender, command, params, text = None):
+        self.sender = sender
+        self.prefix = '%s!%s@loopback' % (sender, sender)
+        self.command = command
+        self.params = params
+        self.text = text
+
+
+class Loopback(object):
+    """Keeps track of users and channels, and delivers messages between the
+    connections in the order they were sent."""
+
+    def __init__(self):
+        self.users = {}
+        self.channels = collections.defaultdict(set)
+        self.lines = 0
+
+    def connect(self, connection):
+        self.users[connection.nick] = connection
+        connection.connected()
+
+    def join(self, nick, channel):
+        members = self.channels[channel]
+        if nick in members:
+            return
+        members.add(nick)
+        for m in members:
+            self.users[m].deliver(Message(nick, 'JOIN', [channel]))
+        self.users[nick].deliver(Message('loopback', '353', [nick, '=', channel] + sorted(members)))
+
+    def part(self, nick, channel):
+        members = self.channels[channel]
+        if nick not in members:
+            return
+        for m in members:
+            self.users[m].deliver(Message(nick, 'PART', [channel]))
+        members.remove(nick)
+
+    def invite(self, nick, user, channel):
+        if user in self.users:
+            self.users[user].deliver(Message(nick, 'INVITE', [user, channel]))
+
+    def privmsg(self, nick, target, text):
+        self.lines += 1
+        if target.startswith('#'):
+            recipients = [m for m in self.channels[target] if m != nick]
+        else:
+            recipients = [target] if target in self.users else []
+        for r in recipients:
+            self.users[r].deliver(Message(nick, 'PRIVMSG', [target] + text.split(' '), text))
+
+
+class Connection(object):
+    """A user of the loopback, providing the same commands to the moderator
+    or client as their IRC libraries."""
+
+    def __init__(self, loopback, nick):
+        self.loopback = loopback
+        self.nick = nick
+        self.inbox = queue.Queue()
+        Greenlet.spawn(self._loop)
+
+    @property
+    def nickname(self):
+        return self.nick
+
+    def deliver(self, msg):
+        self.inbox.put(msg)
+
+    def _loop(self):
+        while True:
+            self.receive(self.inbox.get())
+
+    def msg(self, target, text):
+        self.loopback.privmsg(self.nick, target, text)
+
+    def join(self, channel):
+        self.loopback.join(self.nick, channel)
+
+    def part(self, channel):
+        self.loopback.part(self.nick, channel)
+
+    def invite(self, user, channel):
+        self.loopback.invite(self.nick, user, channel)
+
+
+class ServerConnection(Connection):
+    """Connects a moderator, e.g. a ResistanceCompetitionHandler."""
+
+    def __init__(self, loopback, nick, handler):
+        Connection.__init__(self, loopback, nick)
+        self.handler = handler
+
+    def connected(self):
+        self.deliver(Message('loopback', '001', [self.nick]))
+
+    def pong(self, params):
+        pass
+
+    def receive(self, msg):
+        # Like geventirc, handle each message in its own greenlet.
+        if msg.command in self.handler.commands:
+            Greenlet.spawn(self.handler, self, msg)
+
+
+class BotConnection(Connection):
+    """Connects bots like client.py would, via a ResistanceClient."""
+
+    def __init__(self, loopback, constructors, nick = None):
+        Connection.__init__(self, loopback, nick or constructors[0].__name__)
+        self.client = ResistanceClient(self, constructors)
+
+    def connected(self):
+        self.client.connected()
+
+    def receive(self, msg):
+        if msg.command == 'PRIVMSG':
+            self.client.message(msg.sender, msg.params[0], msg.text)
+        elif msg.command == 'PART' and msg.sender != self.nick:
+            self.client.disconnect(msg.sender, msg.params[0])
+        elif msg.command == 'INVITE':
+            self.client.invited(msg.params[1])
+
+
+class Console(Connection):
+    """Prints everything said in #resistance, and notices when games end."""
+
+    def __init__(self, loopback, nick):
+        Connection.__init__(self, loopback, nick)
+        self.finished = Event()
+
+    def connected(self):
+        self.join('#resistance')
+
+    def receive(self, msg):
+        if msg.command != 'PRIVMSG' or msg.params[0] != '#resistance':
+            return
+        print msg.text
+        if msg.text.startswith('PLAYED') or msg.text.startswith('TIMEOUT'):
+            self.finished.set()
+
+
+def main(games, competitors):
+    loopback = Loopback()
+    handler = ResistanceCompetitionHandler()
+    loopback.connect(ServerConnection(loopback, 'aigamedev', handler))
+    for c in competitors:
+        loopback.connect(BotConnection(loopback, [c]))
+    console = Console(loopback, 'console')
+    loopback.connect(console)
+    # Let all the bots identify themselves to the moderator.
+    gevent.sleep(0.1)
+
+    t = time.time()
+    lines = loopback.lines
+    console.msg('#resistance', 'PLAY %i %s' % (games, ' '.join([c.__name__ for c in competitors])))
+    console.finished.wait()
+    seconds = time.time() - t
+    lines = loopback.lines - lines
+
+    # Wait for the statistics to be printed too.
+    while handler.outbox.depth:
+        gevent.sleep(0.01)
+    gevent.sleep(0.01)
+    print 'LOOPBACK %i lines in %0.2fs, %0.1f per game, %0.1f per second.' % (lines, seconds, float(lines) / games, lines / seconds)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 2:
+        print 'USAGE: loopback.py 1000 file.BotName [...]'
+        sys.exit(-1)
+
+    main(int(sys.argv[1]), getCompetitors(sys.argv[2:]))
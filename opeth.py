@@ -19,27 +19,94 @@ from game import State
 import random
 
 
+class Ordering(object):
+    """Seats sorted by their scores, ascending or descending, then by seat.
+    The position of each seat is kept too, so a seat whose score changed only
+    moves past the seats it overtakes."""
+
+    def __init__(self, scores, descending):
+        self.scores = scores
+        self.sign = -1 if descending else 1
+        self.seats = range(len(scores))
+        self.position = range(len(scores))
+
+    def update(self, seat):
+        seats, position, scores, sign = self.seats, self.position, self.scores, self.sign
+        i = position[seat]
+        k = sign * scores[seat]
+        while i > 0:
+            other = seats[i-1]
+            o = sign * scores[other]
+            if o < k or (o == k and other < seat):
+                break
+            seats[i] = other
+            position[other] = i
+            i -= 1
+        while i < len(seats) - 1:
+            other = seats[i+1]
+            o = sign * scores[other]
+            if k < o or (k == o and seat < other):
+                break
+            seats[i] = other
+            position[other] = i
+            i += 1
+        seats[i] = seat
+        position[seat] = i
+
+    def first(self, count, exclude = None):
+        result = []
+        for s in self.seats:
+            if len(result) == count:
+                break
+            if s != exclude:
+                result.append(s)
+        return result
+
+
+class TrustTable(object):
+    """Confidence scores for each player of a game, stored by seat.  Players
+    are kept in order of trust as their scores change, so the most or least
+    trusted ones are found without sorting everyone.  Ties are broken by seat
+    in both orders."""
+
+    def __init__(self, players):
+        self.players = sorted(players, key = lambda p: p.index)
+        self.scores = [0] * len(self.players)
+        self.trusted = Ordering(self.scores, descending = True)
+        self.distrusted = Ordering(self.scores, descending = False)
+
+    def __getitem__(self, player):
+        return self.scores[player.index-1]
+
+    def adjust(self, player, change):
+        seat = player.index-1
+        self.scores[seat] += change
+        self.trusted.update(seat)
+        self.distrusted.update(seat)
+
+    def top(self, count, exclude = None):
+        """The count most trusted players, maybe except the given one."""
+        return [self.players[s] for s in self.trusted.first(count, self._seat(exclude))]
+
+    def bottom(self, count, exclude = None):
+        """The count least trusted players, maybe except the given one."""
+        return [self.players[s] for s in self.distrusted.first(count, self._seat(exclude))]
+
+    def _seat(self, player):
+        if player is None:
+            return None
+        return player.index-1
+
+    def __repr__(self):
+        return repr(dict(zip(self.players, self.scores)))
+
+
 class Opeth(Bot):
     """Opeth is a melancholic bot."""
 
     # List of spies. We only get this info if we are a spy.
     spy_spies = None
 
-    # My interpretation of the world. This is dict where keys are Player objects
-    # and values are confidence scores for each player. Confidence scores start
-    # at 0 and get higher if I believe that player is not a spy.
-    # We do not use any additional info granted to us if we are a spy to update
-    # this.
-    my_guess = dict()
-
-    # This is like my_guess except we update it based on information that other
-    # resistance members have. It is not as accurate as my_guess but will
-    # provide an insight on what other bots think about the world.
-    their_guess = dict()
-
-    # List of players that I am sure are spies.
-    spies_for_sure = set()
-
     def onGameRevealed(self, players, spies):
         """This function will be called to list all the players, and if you're
         a spy, the spies too -- including others and yourself.
@@ -48,8 +115,20 @@ class Opeth(Bot):
         """
         self.spy_spies = spies
 
-        self.my_guess = dict(zip(players, [0] * 5))
-        self.their_guess = dict(zip(players, [0] * 5))
+        # List of players that I am sure are spies.
+        self.spies_for_sure = set()
+
+        # My interpretation of the world, as a TrustTable of confidence scores
+        # for each player. Confidence scores start at 0 and get higher if I
+        # believe that player is not a spy.
+        # We do not use any additional info granted to us if we are a spy to update
+        # this.
+        self.my_guess = TrustTable(players)
+
+        # This is like my_guess except we update it based on information that other
+        # resistance members have. It is not as accurate as my_guess but will
+        # provide an insight on what other bots think about the world.
+        self.their_guess = TrustTable(players)
 
     def onMissionAttempt(self, mission, tries, leader):
         """Callback function when a new turn begins, before the
@@ -100,8 +179,8 @@ class Opeth(Bot):
         # point in not selecting yourself as part of the team. If they didn't
         # do it, that is suspicious.
         if leader not in team:
-            self.my_guess[leader] -= 5
-            self.their_guess[leader] -= 5
+            self.my_guess.adjust(leader, -5)
+            self.their_guess.adjust(leader, -5)
 
         pass
 
@@ -216,9 +295,9 @@ class Opeth(Bot):
         if len(self.game.team) == sabotaged:
             for spy in self.game.team:
                 if spy.index != self.index:
-                    self.my_guess[spy] -= 100
+                    self.my_guess.adjust(spy, -100)
                     self.spies_for_sure.add(spy)
-                self.their_guess[spy] -= 100
+                self.their_guess.adjust(spy, -100)
 
         # Can we know for sure if the rest of the team is a spy?
         # 3 conditions: I am not a spy, I am in the team,
@@ -227,7 +306,7 @@ class Opeth(Bot):
         if not self.spy and self in self.game.team and sabotaged == len(self.game.team) - 1:
             for spy in self.game.team:
                 if spy.index != self.index:
-                    self.my_guess[spy] -= 100
+                    self.my_guess.adjust(spy, -100)
                     self.spies_for_sure.add(spy)
 
         # If this mission failed, that team gets penalized (according to the number of times the mission was sabotaged),
@@ -235,21 +314,21 @@ class Opeth(Bot):
         for player in self.game.team:
             if sabotaged:
                 if player.index != self.index:
-                    self.my_guess[player] -= sabotaged
-                self.their_guess[player] -= sabotaged
+                    self.my_guess.adjust(player, -sabotaged)
+                self.their_guess.adjust(player, -sabotaged)
             else:
-                self.my_guess[player] += 2
-                self.their_guess[player] += 2
+                self.my_guess.adjust(player, 2)
+                self.their_guess.adjust(player, 2)
 
         # If the leader is not in the team but the mission succeded, restore confidence in him, I guess.
         if self.game.leader not in self.game.team:
             if sabotaged == 0:
-                self.my_guess[self.game.leader] += 5
-                self.their_guess[self.game.leader] += 5
+                self.my_guess.adjust(self.game.leader, 5)
+                self.their_guess.adjust(self.game.leader, 5)
             else:
                 # If the mission was sabottaged, punish him further.
-                self.my_guess[self.game.leader] -= sabotaged
-                self.their_guess[self.game.leader] -= sabotaged
+                self.my_guess.adjust(self.game.leader, -sabotaged)
+                self.their_guess.adjust(self.game.leader, -sabotaged)
 
         # Print stats
         if sabotaged == 0:
@@ -299,10 +378,11 @@ class Opeth(Bot):
         """Returns a sorted list of the number_players more trustworthy players.
         @param number_players How many players do you want?
         """
-        sorted_list = sorted(self.game.players, key=lambda player: self.my_guess[player], reverse=not reversed)
-        sorted_list.remove(self)
-        return sorted_list[:number_players]
+        if reversed:
+            return self.my_guess.bottom(number_players, exclude=self)
+        return self.my_guess.top(number_players, exclude=self)
 
     def getPlayersTheyTrust(self, number_players, reversed=False):
-        sorted_list = sorted(self.game.players, key=lambda player: self.their_guess[player], reverse=not reversed)
-        return sorted_list[:number_players]
\ No newline at end of file
+        if reversed:
+            return self.their_guess.bottom(number_players)
+        return self.their_guess.top(number_players)
\ No newline at end of file
@@ -8,7 +8,7 @@
 # - (DONE) Run multiple games in parallel in multiple greenlets for speed.
 # - (DONE) Let the server detect if the bot is already in the private channel.
 # - (DONE) Have clients detect if the server disconnects or leaves a channel.
-# - For speed, use a constant set of bot channels rather than game channels.
+# - (DONE) For speed, use a constant set of bot channels rather than game channels.
 # - For speed, run multiple games with the same bots, different configurations. 
 
 # HUMAN PLAY
@@ -24,59 +24,692 @@
 # - (DONE) Require a sabotage response from humans, always to make it fair.
 # - Handle renaming of clients so the player list is up-to-date.
 
+import os
 import sys
+import json
 import time
+import heapq
 import random
+import subprocess
 import logging
 import itertools
+import collections
 
+import gevent
 from gevent import Greenlet
 from gevent import queue
 from gevent import pool 
-from gevent.event import Event, AsyncResult, Timeout
+from gevent import Timeout
+from gevent import socket
+from gevent.event import Event, AsyncResult
+from gevent.lock import Semaphore
+from gevent.server import StreamServer
 from geventirc import Client
 from geventirc import message
 
-from competition import CompetitionRunner, CompetitionRound
+import wire
+import codec
+import distributed
+
+import competition
+from competition import CompetitionRunner, CompetitionRound, getCompetitors
 from player import Player, Bot
 from game import Game
 
 
+# Most games to play at once, each with its own channel, and how many PLAY
+# requests can be waiting before further ones are held back.
 CHANNELS = 100
+UPCOMING = 100
+
+# Longest line of batched messages to send to bots before flushing early.
+BATCH_LENGTH = 400
+
+# Sustained rate in lines per second the IRC server accepts without
+# throttling, and how many lines can be sent in a burst above it.
+RATE = None
+BURST = 10
+
+# Where the moderator keeps track of requests and results across restarts.
+JOURNAL = 'logs/moderator.journal'
+
+# Local port where shards of a moderator running over multiple processes
+# connect to get the games they should play.
+COORDINATOR = 6669
+
+# How long games wait for a bot that disconnected to resume its session.
+RESUME = 30.0
+
+# Most game events a spectator can fall behind by before it's dropped.
+BACKLOG = 1000
+
+# Priorities of outgoing messages, most urgent first.
+GAME, CHATTER = range(2)
+
+# Bounds in seconds for how long bots get to reply, adapted in between from
+# how fast each bot replied so far, and the deadline for bots not yet seen.
+TIMEOUTS = (0.25, 5.0)
+TIMEOUT = 1.0
+
+
+
+def bind(address, host = ''):
+    """Listener for a TCP port, or a Unix socket if given a path."""
+    if '/' not in address:
+        return (host, int(address))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(50)
+    return listener
+
+
+class Outbox(object):
+    """Sends all outgoing messages from a single greenlet, within the rate
+    budget of the IRC server.  Game messages go out before the chatter in
+    #resistance, and consecutive messages to the same channel are merged
+    into one line if they allow it."""
+
+    def __init__(self, client, rate = RATE, burst = BURST):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+
+        self.queues = [collections.deque() for p in (GAME, CHATTER)]
+        self.ready = Event()
+        self.sent = 0
+        self.merged = 0
+        self.peak = 0
+        Greenlet.spawn(self._loop)
+
+    @property
+    def depth(self):
+        return sum([len(q) for q in self.queues])
+
+    def msg(self, channel, text, priority = GAME, prefix = '', merge = False):
+        """Queue a message, and return an AsyncResult that's set to the time
+        it was sent."""
+        sent = AsyncResult()
+        self.queues[priority].append((channel, prefix, merge, [text], [sent]))
+        self.peak = max(self.peak, self.depth)
+        self.ready.set()
+        return sent
+
+    def command(self, name, *args):
+        """Queue an IRC command like 'join', 'part' or 'invite'."""
+        self.queues[GAME].append((None, (name, args), False, [], []))
+        self.ready.set()
+
+    def status(self):
+        return 'QUEUE %i, peak %i; SENT %i lines, %i merged.' % (self.depth, self.peak, self.sent, self.merged)
+
+    def _take(self):
+        while self.rate is not None:
+            now = time.time()
+            self.tokens = min(float(self.burst), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            gevent.sleep((1.0 - self.tokens) / self.rate)
+
+    def _loop(self):
+        while True:
+            self.ready.wait()
+            queue = [q for q in self.queues if q]
+            if not queue:
+                self.ready.clear()
+                continue
+
+            queue = queue[0]
+            channel, prefix, merge, texts, events = queue.popleft()
+            while merge and queue and queue[0][:3] == (channel, prefix, merge) \
+                  and len(codec.SEPARATOR.join(texts + queue[0][3])) <= BATCH_LENGTH:
+                texts.extend(queue[0][3])
+                events.extend(queue.popleft()[4])
+                self.merged += 1
+
+            self._take()
+            if channel is None:
+                name, args = prefix
+                getattr(self.client, name)(*args)
+            else:
+                self.client.msg(channel, prefix + codec.SEPARATOR.join(texts))
+            self.sent += 1
+            now = time.time()
+            for e in events:
+                e.set(now)
+
+
+class Latency(object):
+    """Tracks how long a bot takes to reply, as a moving average and mean
+    deviation like TCP's retransmission timer, to give it a deadline that's
+    generous for slow bots yet doesn't wait long for fast ones that hang.
+    Like that timer, the deadline doubles after each timeout until the bot
+    replies in time again."""
+
+    GAIN = 0.125
+    DEVIATIONS = 4.0
+    # How much of the slowest reply is forgotten with each new one.
+    DECAY = 0.02
+
+    def __init__(self, bounds = TIMEOUTS):
+        self.bounds = bounds
+        self.average = None
+        self.deviation = 0.0
+        self.worst = 0.0
+        self.backoff = 1.0
+        self.calls = 0
+        self.timeouts = 0
+
+    def deadline(self):
+        if self.average is None:
+            t = TIMEOUT
+        else:
+            # Allow for the slowest replies seen lately, in case they're rare.
+            t = max(self.average + self.DEVIATIONS * self.deviation, self.worst * 1.5)
+        return max(self.bounds[0], min(t * self.backoff, self.bounds[1]))
+
+    def sample(self, seconds):
+        self.calls += 1
+        self.backoff = 1.0
+        self.worst = max(self.worst * (1.0 - self.DECAY), seconds)
+        if self.average is None:
+            self.average, self.deviation = seconds, seconds / 2.0
+            return
+        self.deviation += self.GAIN * (abs(seconds - self.average) - self.deviation)
+        self.average += self.GAIN * (seconds - self.average)
+
+    def timeout(self):
+        self.calls += 1
+        self.timeouts += 1
+        if self.deadline() < self.bounds[1]:
+            self.backoff *= 2.0
+
+    def __repr__(self):
+        return '%4i/%-6i %6.1fms %7.1fms' % (self.timeouts, self.calls, 1000.0 * (self.average or 0.0), 1000.0 * self.deadline())
+
+
+class Scheduler(object):
+    """Decides how many games are played at once, like TCP congestion control
+    does for packets: the limit grows by about one game per batch of games
+    that went well, and halves when bots time out, the outbox backs up, or
+    bots take much longer to reply than they did at best.  Channels are handed
+    out lowest first, so that bots keep reusing the same few."""
+
+    # How much slower than at best replies can get before backing off.
+    TOLERANCE = 2.0
+    GAIN = 0.05
+
+    def __init__(self, outbox, maximum = CHANNELS, minimum = 1):
+        self.outbox = outbox
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(minimum)
+        self.free = range(0, maximum)
+        self.active = 0
+        self.available = Event()
+        self.available.set()
+
+        self.average = None
+        self.baseline = None
+        self.holdoff = 0
+        self.backoffs = 0
+
+    def acquire(self):
+        """Wait until another game can start, and return its channel index."""
+        while self.active >= int(self.limit):
+            self.available.clear()
+            self.available.wait()
+        self.active += 1
+        return heapq.heappop(self.free)
+
+    def sample(self, seconds):
+        """Round trip time from sending a prompt to a bot until its reply."""
+        if self.average is None:
+            self.average = self.baseline = seconds
+            return
+        self.average += self.GAIN * (seconds - self.average)
+        # Let the baseline drift up slowly, in case conditions changed.
+        if self.average < self.baseline:
+            self.baseline = self.average
+        else:
+            self.baseline += self.GAIN * 0.1 * (self.average - self.baseline)
+
+    def release(self, index, timeout):
+        self.active -= 1
+        heapq.heappush(self.free, index)
+
+        congested = timeout \
+                 or self.outbox.depth > max(self.limit, BURST) \
+                 or (self.average is not None and self.average > self.baseline * self.TOLERANCE)
+        if not congested:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        elif self.holdoff <= 0:
+            # Back off once for all the games that were started too eagerly.
+            self.limit = max(self.minimum, self.limit / 2.0)
+            self.holdoff = self.active
+            self.backoffs += 1
+        self.holdoff -= 1
+        self.available.set()
+
+    def status(self):
+        return 'GAMES %i of %i, %i backoffs; LATENCY %0.1fms, best %0.1fms.' % (self.active, int(self.limit), self.backoffs, 1000.0 * (self.average or 0.0), 1000.0 * (self.baseline or 0.0))
+
+
+class Request(object):
+    """A batch of games asked for with PLAY, and how far along it is."""
+
+    def __init__(self, number, requester, candidates, games):
+        self.number = number
+        self.requester = requester
+        self.candidates = candidates
+        self.games = games
+        self.remaining = games
+        self.playing = 0
+        self.played = 0
+        self.wins = 0
+        self.timeouts = 0
+        self.cancelled = False
+        self.started = time.time()
+        self.finished = Event()
+        # Games played before a restart, when recovered from the journal.
+        self.resumed = 0
+
+    def take(self):
+        self.remaining -= 1
+        self.playing += 1
+
+    def complete(self, won):
+        self.playing -= 1
+        self.played += 1
+        if won is None:
+            self.timeouts += 1
+        else:
+            self.wins += int(won)
+        self._check()
+
+    def cancel(self):
+        self.cancelled = True
+        self.remaining = 0
+        self._check()
+
+    def _check(self):
+        if self.remaining <= 0 and self.playing == 0:
+            self.finished.set()
+
+    def __repr__(self):
+        seconds = time.time() - self.started
+        return 'REQUEST %i by %s: %i of %i played, %i playing, %i timed out, at %0.2f GPS.' \
+                % (self.number, self.requester, self.played, self.games, self.playing, self.timeouts, self.played / seconds)
+
+
+class FairQueue(object):
+    """Hands out games from pending requests round-robin between the users
+    that asked for them, so a large batch doesn't hold up everyone else.
+    Each user's own requests are played in order."""
 
+    def __init__(self, capacity = UPCOMING):
+        self.requesters = collections.OrderedDict()
+        self.slots = Semaphore(capacity)
+        self.ready = Event()
+        self.closed = False
 
-def showYesOrNo(b):
-    result = {True: 'Yes', False: 'No'}
-    return result[b]
+    def __iter__(self):
+        for requests in self.requesters.values():
+            for r in requests:
+                yield r
+
+    def put(self, request):
+        """Add a request, waiting while too many are pending already."""
+        self.slots.acquire()
+        self.requesters.setdefault(request.requester, collections.deque()).append(request)
+        self.ready.set()
+
+    def get(self):
+        """Wait for the next game to play, and return the request it's for
+        or None once closed."""
+        while not self.requesters and not self.closed:
+            self.ready.clear()
+            self.ready.wait()
+        if self.closed:
+            return None
+
+        # The requester goes to the back of the line if it has more games.
+        requester, requests = self.requesters.popitem(last = False)
+        request = requests[0]
+        request.take()
+        if request.remaining <= 0:
+            self._remove(request, requests)
+        if requests:
+            self.requesters[requester] = requests
+        return request
+
+    def restore(self, request, count):
+        """Put back games that were taken but couldn't be played."""
+        request.playing -= count
+        if request.cancelled:
+            request._check()
+            return
+        request.remaining += count
+        requests = self.requesters.get(request.requester)
+        if requests is None or request not in requests:
+            self.slots.acquire()
+            self.requesters.setdefault(request.requester, collections.deque()).appendleft(request)
+            self.ready.set()
+
+    def cancel(self, request):
+        requests = self.requesters.get(request.requester, ())
+        if request in requests:
+            self._remove(request, requests)
+            if not requests:
+                del self.requesters[request.requester]
+        request.cancel()
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    def _remove(self, request, requests):
+        requests.remove(request)
+        self.slots.release()
+
+
+class Journal(object):
+    """Append-only log of PLAY requests, game results and the statistics
+    they added, one JSON object per line, so the moderator can carry on
+    where it left off after a crash or restart.  It's compacted into a
+    snapshot of the current state on startup and when it grows large."""
+
+    RECORDS = 10000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.requests = {}
+        self.last = 0
+        self.records = 0
+        self.file = None
+        self.replay()
+        self.compact(self.requests.values())
+
+    def replay(self):
+        """Rebuild the global statistics and unfinished requests."""
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    # The last record may be incomplete after a crash.
+                    break
+
+                event = r['event']
+                if event == 'snapshot':
+                    competition.statistics = {}
+                    competition.mergeStatistics(r['statistics'])
+                elif event == 'shown':
+                    competition.statistics = {}
+                elif event == 'request':
+                    r.setdefault('played', 0)
+                    r.setdefault('wins', 0)
+                    r.setdefault('timeouts', 0)
+                    self.requests[r['request']] = r
+                    self.last = max(self.last, r['request'])
+                elif event == 'game':
+                    request = self.requests.get(r['request'])
+                    if request is not None:
+                        request['played'] += 1
+                        if r['won'] is None:
+                            request['timeouts'] += 1
+                        else:
+                            request['wins'] += int(r['won'])
+                    competition.mergeStatistics(r['statistics'])
+                elif event == 'done':
+                    self.requests.pop(r['request'], None)
+
+    def write(self, event, **record):
+        record['event'] = event
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.records += 1
+
+    def request(self, r):
+        self.write('request', request = r.number, requester = r.requester, candidates = r.candidates,
+                   games = r.games, played = r.played, wins = r.wins, timeouts = r.timeouts)
+
+    def compact(self, requests):
+        """Replace the journal by a snapshot of the statistics and the
+        requests that are still pending."""
+        if self.file:
+            self.file.close()
+        tmp = self.filename + '.tmp'
+        self.file = open(tmp, 'w')
+        self.write('snapshot', statistics = dict([(n, s.dump()) for n, s in competition.statistics.items()]))
+        for r in requests:
+            if isinstance(r, dict):
+                r = self.recover(r)
+            self.request(r)
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(tmp, self.filename)
+
+        self.file = open(self.filename, 'a')
+        self.records = 0
+
+    def recover(self, r):
+        """Request for the games that were still to be played."""
+        request = Request(r['request'], r['requester'], r['candidates'], r['games'])
+        request.played = request.resumed = r['played']
+        request.wins = r['wins']
+        request.timeouts = r['timeouts']
+        request.remaining = r['games'] - r['played']
+        return request
+
+
+class Spectator(object):
+    """Connection of an observer, sent game events from its own queue so
+    that it can't hold up games.  If it falls too far behind, it's dropped."""
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.lines = collections.deque()
+        self.ready = Event()
+        self.dropped = False
+
+    def push(self, line):
+        if len(self.lines) >= BACKLOG:
+            self.dropped = True
+        else:
+            self.lines.append(line)
+        self.ready.set()
+        return not self.dropped
+
+    def serve(self):
+        try:
+            while not self.dropped:
+                self.ready.wait()
+                self.ready.clear()
+                while self.lines and not self.dropped:
+                    self.socket.sendall(self.lines.popleft())
+        except socket.error:
+            self.dropped = True
+        finally:
+            self.socket.close()
+
+
+class Spectators(object):
+    """Publishes the events of all games as JSON lines to any number of
+    observers connected to a Unix socket or local TCP port."""
+
+    def __init__(self):
+        self.subscribers = set()
+        self.dropped = 0
+
+    def listen(self, address):
+        StreamServer(bind(address, '127.0.0.1'), self.subscribe).start()
+
+    def subscribe(self, sock, address):
+        s = Spectator(sock)
+        self.subscribers.add(s)
+        try:
+            s.serve()
+        finally:
+            self.subscribers.discard(s)
+
+    def publish(self, game, event, **details):
+        if not self.subscribers:
+            return
+        details['game'] = game
+        details['event'] = event
+        line = json.dumps(details) + '\n'
+        for s in list(self.subscribers):
+            if not s.push(line):
+                self.subscribers.discard(s)
+                self.dropped += 1
+        # Games between hosted bots never wait, so let the events go out.
+        gevent.sleep(0)
+
+
+class SpectatedRound(CompetitionRound):
+    """Competition game that reports what happens to spectators."""
+
+    def __init__(self, bots, spectators):
+        CompetitionRound.__init__(self, bots)
+        self.spectators = spectators
+
+    def onGameRevealed(self, players, spies):
+        # Bots may be watching too, so the spies are only told in the result.
+        self.spectators.publish(self.channel, 'reveal', players = [p.name for p in players])
+
+    def onMissionAttempt(self, mission, tries, leader):
+        self.spectators.publish(self.channel, 'mission', mission = mission, tries = tries, leader = leader.index)
+
+    def onTeamSelected(self, leader, team):
+        self.spectators.publish(self.channel, 'team', leader = leader.index, team = sorted([p.index for p in team]))
+
+    def onVoteComplete(self, votes):
+        self.spectators.publish(self.channel, 'votes', votes = votes)
+
+    def onMissionComplete(self, sabotaged):
+        self.spectators.publish(self.channel, 'sabotages', sabotaged = sabotaged)
+
+    def onGameComplete(self, win, spies):
+        self.spectators.publish(self.channel, 'result', win = win, spies = sorted([p.index for p in spies]))
+
+
+class Shard(object):
+    """Moderator process that plays games on behalf of the coordinator, as
+    seen by the coordinator.  It's handed games as it has room for them, and
+    if it's lost the games it was playing are put back in the queue."""
+
+    def __init__(self, handler, sock):
+        self.handler = handler
+        self.socket = sock
+        self.stream = sock.makefile('rw')
+        self.lock = Semaphore()
+        self.outstanding = {}
+        self.lost = False
+
+    def send(self, data):
+        with self.lock:
+            distributed.send(self.stream, data)
+
+    def serve(self):
+        self.handler.shards.add(self)
+        try:
+            while True:
+                msg = distributed.receive(self.stream)
+                if 'ready' in msg:
+                    Greenlet.spawn(self._assign)
+                else:
+                    self._complete(msg)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            self.lost = True
+            self.handler.shards.discard(self)
+            for request, count in self.outstanding.values():
+                self.handler.upcoming.restore(request, count)
+            self.outstanding = {}
+
+    def _assign(self):
+        request = self.handler.upcoming.get()
+        if request is None:
+            return
+        if self.lost:
+            return self.handler.upcoming.restore(request, 1)
+
+        self.outstanding.setdefault(request.number, [request, 0])[1] += 1
+        names = [c.lstrip('@') for c in request.candidates]
+        identities = dict([(n, list(self.handler.identities.get(n, ()))) for n in names if n in self.handler.identities])
+        hosts = dict([(n, self.handler.hosts[n]) for n in names if n in self.handler.hosts])
+        try:
+            self.send({'request': request.number, 'candidates': request.candidates, 'identities': identities, 'hosts': hosts})
+        except socket.error:
+            pass
+
+    def resumed(self, nick, counts):
+        """Pass on that a client resumed its session, as it only tells the
+        coordinator but may be playing games in this shard."""
+        try:
+            self.send({'resumed': nick, 'counts': counts})
+        except socket.error:
+            pass
 
-def parseYesOrNo(text):
-    text = text.lower()
-    result = None
-    for t in ['yes', 'true']:
-        if t in text: result = True
-    for t in ['no', 'false']:
-        if t in text: result = False
-    return result 
+    def _complete(self, msg):
+        request, count = self.outstanding[msg['request']]
+        if count == 1:
+            del self.outstanding[msg['request']]
+        else:
+            self.outstanding[msg['request']][1] -= 1
+        self.handler.record(request, msg['won'], msg['statistics'])
 
 
 class ProxyBot(Bot):
 
-    def __init__(self, name, client, game, bot):
+    def __init__(self, name, handler, game, bot, number):
         self.name = name
-        self.client = client
+        self.handler = handler
+        self.outbox = handler.outbox
         self.bot = bot
+        # Nickname of the client playing for this bot, maybe for many bots.
+        self.host = handler.hosts.get(name, name)
+        # Humans take as long as they like, bots get a deadline per reply.
         if bot:
-            self.TIMEOUT = 1.0
+            self.latency = handler.latency(name)
+        else:
+            self.latency = None
+
+        # Bots that support it share one private channel for all their games,
+        # with messages prefixed by the name each game's channel would have.
+        self.multiplex = 'MULTIPLEX' in handler.identities.get(name, ())
+        self.channel = None
+
+        # Bots that support it get all the information that doesn't need a
+        # reply together on one line, separated by '|', with the next prompt.
+        if 'BATCH' in handler.identities.get(name, ()):
+            self.batch = []
         else:
-            self.TIMEOUT = None
+            self.batch = None
 
         self.expecting = None
+        # Messages sent since the bot last replied, numbered from the start
+        # of the game, to send again those it missed if it resumes.
+        self.sequence = 0
+        self.posted = 0
+        self.backlog = []
+        self.synced = time.time()
+        self._sent = None
         self._vote = None
         self._select = None
         self._sabotage = None
         self._join = None
         self._part = None
         self.game = game 
+        self.number = number
 
     def __call__(self, game, index, spy):
         """This function pretends to be a Builder, but in fact just
@@ -86,87 +719,161 @@ class ProxyBot(Bot):
         self.spy = spy
 
         self.channel = '%s-player-%i' % (self.game, index)
-        self.client.send_message(message.Join(self.channel))
-        self.client.send_message(message.Join(self.game))
+        if self.multiplex:
+            # Only a name in this case, with the game's number so that counts
+            # from a resuming client can't be mistaken for an earlier game's.
+            self.channel = '%s.%i-player-%i' % (self.game, self.number, index)
+        self.handler.seats[self.channel] = self
+        if self.multiplex:
+            self.target = '#bot-%s' % (self.host)
+            self._join = self.handler.joinBotChannel(self.host, self.target)
+            return self
+
+        self.target = self.channel
+        self.outbox.command('join', self.channel)
+        self.outbox.command('join', self.game)
 
         self._join = Event() 
         # Use elegant /INVITE command for humans that have better clients.
-        self.client.send_message(message.Command([self.name, self.channel], 'INVITE'))
+        self.outbox.command('invite', self.host, self.channel)
         return self
 
-    def bakeTeam(self, team):
-        return ', '.join([str(p) for p in team])
-
-    def makeTeam(self, msg):
-        for s in '\t,.!;?': msg = msg.replace(s, ' ')
-        names = [n for n in msg.split(' ') if n]
-        players = []
-        for n in names:
-            players.append(self.makePlayer(n))
-        return players
-
-    def makePlayer(self, name):
-        for p in self.state.players:
-            if str(p.index) in name:
-                return p
-            if name in p.name:
-                return p
-        assert False, "Can't find player for input name '%s'." % (name)
+    def tell(self, msg):
+        if self.batch is None:
+            return self.send(msg)
+
+        # Send what's batched already if this wouldn't fit on the same line.
+        if not self.fits(msg):
+            self.flush()
+        self.record(msg)
+        self.batch.append(msg)
+
+    def fits(self, msg):
+        return len(codec.SEPARATOR.join(self.batch + [msg])) <= BATCH_LENGTH
+
+    def flush(self):
+        if self.batch:
+            self.post(codec.SEPARATOR.join(self.batch))
+            self.batch = []
 
     def send(self, msg):
-        self.client.msg(self.channel, msg)
+        if self.batch is not None and not self.fits(msg):
+            self.flush()
+        self.record(msg)
+        if self.batch:
+            msg = codec.SEPARATOR.join(self.batch + [msg])
+            self.batch = []
+        self._sent = self.post(msg)
 
-    def onGameRevealed(self, players, spies):
-        roles = {True: "Spy", False: "Resistance"}
-        s = ""
-        if self.spy:
-            s = "; SPIES " + self.bakeTeam(spies)
+    def record(self, msg):
+        self.sequence += 1
+        self.backlog.append((self.sequence, msg))
+
+    def post(self, msg):
+        # Messages to a client that's away would be lost.
+        self.handler.returned(self.host)
+        self.replay()
+        self.posted = self.sequence
+        return self.outbox.msg(self.target, msg, GAME, self.prefix(), self.batch is not None)
+
+    def prefix(self):
+        if self.multiplex:
+            return '%s ' % (self.channel)
+        return ''
+
+    def replay(self):
+        """Send again what the bot missed if its client resumed its session
+        since, and return when the last of it is sent."""
+        resumed = self.handler.resumed.get(self.host)
+        if resumed is None or resumed[0] <= self.synced:
+            return None
+        self.synced = resumed[0]
+        # Messages are counted by the client as they're processed.
+        processed = resumed[1].get(self.channel, 0)
+        missed = [m for n, m in self.backlog if processed < n <= self.posted]
+        sent = None
+        for m in missed:
+            sent = self.outbox.msg(self.target, m, GAME, self.prefix(), self.batch is not None)
+        return sent
+
+    def wait(self, result):
+        # Only start the timeout once the question was actually sent.
+        sent = self._sent.get()
+        if self.latency is None:
+            value = result.get()
+            self.backlog = []
+            return value
+
+        while True:
+            remaining = sent + self.latency.deadline() - time.time()
+            try:
+                value = result.get(timeout=max(remaining, 0.0))
+                break
+            except Timeout:
+                if not self.handler.reconnected(self.host, sent):
+                    self.latency.timeout()
+                    raise
+            # Ask again even if the bot got the question, as its reply may
+            # have been lost instead.
+            self._sent = self.replay()
+            if self._sent is None:
+                self._sent = self.outbox.msg(self.target, self.backlog[-1][1], GAME, self.prefix())
+            sent = self._sent.get()
+        # Replying shows the bot processed everything sent before.
+        self.backlog = []
+        self.latency.sample(time.time() - sent)
+        self.handler.scheduler.sample(time.time() - sent)
+        return value
 
+    def onGameRevealed(self, players, spies):
         self._join.wait()
         self._join = None
-        self.send('REVEAL %s; ROLE %s; PLAYERS %s%s.' % (self.game, roles[self.spy], self.bakeTeam(players), s))
+        self.tell(codec.reveal(self.game, self.spy, players, spies))
 
     def onMissionAttempt(self, mission, tries, leader):
-        self.send('MISSION %i.%i; LEADER %s.' % (mission, tries, Player.__repr__(leader)))
+        self.tell(codec.mission(mission, tries, leader))
 
     def select(self, players, count):
-        self.send('SELECT %i!' % (count))
+        self.send(codec.select(count))
         self._select = AsyncResult()
         self.state.count = count
         self.expecting = self.process_SELECTED
-        return self._select.get(timeout=self.TIMEOUT)
+        return self.wait(self._select)
 
     def process_SELECTED(self, msg):
         if 'select' in msg[1].lower():
             msg = ' '.join(msg[2:])
         else:
             msg = ' '.join(msg[1:])
-        team = self.makeTeam(msg)
+        try:
+            team = codec.findPlayers(msg, self.state.players)
+        except ValueError:
+            team = []
         if len(team) != self.state.count:
-            self.send('SELECT %i?' % (self.state.count))
+            self.send(codec.select(self.state.count, again = True))
         else:
             self._select.set(team)
 
     def onTeamSelected(self, leader, team):
         self.state.team = team[:]
-        self.send("VOTE %s?" % (self.bakeTeam(team)))
+        self.send(codec.vote(team))
         self._vote = AsyncResult()
         self.expecting = self.process_VOTED
 
     def vote(self, team):
-        return self._vote.get(timeout=self.TIMEOUT)
+        return self.wait(self._vote)
 
     def process_VOTED(self, msg):
-        result = parseYesOrNo(' '.join(msg[1:]))
+        result = codec.parseYesOrNo(' '.join(msg[1:]))
         if result is not None:
             self._vote.set(result)
 
     def onVoteComplete(self, votes):
-        self.send("VOTES %s." % (', '.join([showYesOrNo(v) for v in votes])))
+        self.tell(codec.votes(votes))
         
         v = [b for b in votes if b]
         if self in self.state.team and len(v) > 2:
-            self.send("SABOTAGE?")
+            self.send(codec.sabotage())
             self._sabotage = AsyncResult()
             self.expecting = self.process_SABOTAGED
         else:
@@ -174,10 +881,10 @@ class ProxyBot(Bot):
 
     def sabotage(self):
         assert self._sabotage is not None
-        return self._sabotage.get(timeout=self.TIMEOUT)
+        return self.wait(self._sabotage)
 
     def process_SABOTAGED(self, msg):
-        result = parseYesOrNo(' '.join(msg[1:]))
+        result = codec.parseYesOrNo(' '.join(msg[1:]))
         if result is not None:
             self._sabotage.set(result)
 
@@ -186,38 +893,378 @@ class ProxyBot(Bot):
         # being resistance.  This helps hide human identity by having the same
         # input delay in Spy or Resistance cases.
         if self._sabotage and not self._sabotage.ready():
-            s = self._sabotage.get(timeout=self.TIMEOUT)
+            s = self.wait(self._sabotage)
             assert not s, "Expecting sabotage() to be False if it was handled automatically."
 
-        self.send("SABOTAGES %i." % (sabotaged))
+        self.tell(codec.sabotages(sabotaged))
         self.expecting = None
 
     def onGameComplete(self, win, spies):
-        self.send("RESULT %s; SPIES %s." % (showYesOrNo(win), self.bakeTeam(spies)))
+        self.send(codec.result(win, spies))
+        if self.multiplex:
+            return
 
-        self.client.send_message(message.Command(self.game, 'PART'))
+        self.outbox.command('part', self.game)
         self._part = Event() 
         self._part.wait()
-        self.client.send_message(message.Command(self.channel, 'PART'))
+        self.outbox.command('part', self.channel)
+
+
+class IrcTransport(object):
+    """Connects the moderator to a real IRC server via geventirc, providing
+    the few commands it needs.  See loopback.py for an in-process version."""
+
+    def __init__(self, client, handler):
+        self.client = client
+        self.handler = handler
+        self.commands = handler.commands
+
+    @property
+    def nick(self):
+        return self.client.nick
+
+    def msg(self, channel, text):
+        self.client.msg(channel, text)
+
+    def join(self, channel):
+        self.client.send_message(message.Join(channel))
+
+    def part(self, channel):
+        self.client.send_message(message.Command(channel, 'PART'))
+
+    def invite(self, user, channel):
+        self.client.send_message(message.Command([user, channel], 'INVITE'))
+
+    def pong(self, params):
+        self.client.send_message(message.Command(params, 'PONG'))
+
+    def __call__(self, client, msg):
+        self.handler(self, msg)
+
+
+class BinaryConnection(object):
+    """Client connected with the binary protocol from wire.py, hosting the
+    bots named in its HELLO."""
+
+    def __init__(self, handler, sock):
+        self.handler = handler
+        self.socket = sock
+        self.lock = Semaphore()
+        self.names = []
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        # Frames must not interleave when sending yields to other greenlets.
+        with self.lock:
+            self.socket.sendall(wire.frame(data))
+
+    def serve(self):
+        stream = self.socket.makefile('rb')
+        try:
+            while True:
+                data = wire.read(stream)
+                if data is None:
+                    break
+                opcode, game, seat, payload = wire.unpack(data)
+                if opcode == wire.HELLO:
+                    self.names = payload.split(' ')
+                    self.handler.connect(self)
+                    continue
+
+                bot = self.handler.seats.get((game, seat))
+                if bot is not None:
+                    bot.receive(opcode, payload)
+        except socket.error:
+            pass
+        finally:
+            self.handler.disconnect(self)
+
+
+class BinaryBot(ProxyBot):
+    """Stands in for a bot connected with the binary protocol, which refers
+    to players by seat and to teams and votes as bitmasks."""
+
+    def __init__(self, name, handler, game, connection, number):
+        ProxyBot.__init__(self, name, handler, game, True, number)
+        self.connection = connection
+
+    def __call__(self, game, index, spy):
+        Player.__init__(self, self.name, index)
+        self.state = game
+        self.spy = spy
+        # Replies are routed by game number and seat instead of channel.
+        self.channel = (self.number, index)
+        self.handler.seats[self.channel] = self
+        return self
+
+    def send(self, msg):
+        # Text from the moderator, e.g. SABOTAGES typed by a human.
+        pass
+
+    def transmit(self, opcode, *values):
+        # Nothing gets queued, so prompts are out as soon as they're sent.
+        self.connection.send(wire.pack(opcode, self.number, self.index, *values))
+        self._sent = AsyncResult()
+        self._sent.set(time.time())
+
+    def onGameRevealed(self, players, spies):
+        names = wire.packNames([p.name for p in players])
+        self.connection.send(wire.pack(wire.REVEAL, self.number, self.index, int(self.spy), wire.mask(spies)) + names)
+
+    def onMissionAttempt(self, mission, tries, leader):
+        self.transmit(wire.MISSION, mission, tries, leader.index)
+
+    def select(self, players, count):
+        self.state.count = count
+        self._select = AsyncResult()
+        self.transmit(wire.SELECT, count)
+        return self.wait(self._select)
+
+    def onTeamSelected(self, leader, team):
+        self.state.team = team[:]
+        self._vote = AsyncResult()
+        self.transmit(wire.VOTE, wire.mask(team))
+
+    def onVoteComplete(self, votes):
+        self.transmit(wire.VOTES, sum([int(v) << i for i, v in enumerate(votes)]))
+        if self in self.state.team and len([v for v in votes if v]) > 2:
+            self._sabotage = AsyncResult()
+            self.transmit(wire.SABOTAGE)
+        else:
+            self._sabotage = None
+
+    def onMissionComplete(self, sabotaged):
+        if self._sabotage and not self._sabotage.ready():
+            s = self.wait(self._sabotage)
+            assert not s, "Expecting sabotage() to be False if it was handled automatically."
+        self.transmit(wire.SABOTAGES, sabotaged)
+
+    def onGameComplete(self, win, spies):
+        self.transmit(wire.RESULT, int(win), wire.mask(spies))
+
+    def receive(self, opcode, payload):
+        # Replies that weren't asked for are ignored, as over IRC.
+        if opcode == wire.SELECTED and self._select is not None:
+            team = wire.unmask(ord(payload[0]), self.state.players)
+            if len(team) != self.state.count:
+                self.transmit(wire.SELECT, self.state.count)
+            else:
+                self._select.set(team)
+        elif opcode == wire.VOTED and self._vote is not None:
+            self._vote.set(bool(ord(payload[0])))
+        elif opcode == wire.SABOTAGED and self._sabotage is not None:
+            self._sabotage.set(bool(ord(payload[0])))
 
 
 class ResistanceCompetitionHandler(CompetitionRunner):
     """Host that moderates games of THE RESISTANCE given an IRC server."""
 
-    commands = ['PRIVMSG', 'PING', 'JOIN', 'PART',
+    commands = ['PRIVMSG', 'PING', 'JOIN', 'PART', 'QUIT',
                 '001', # CONNECT
                 '353', # NAMES
     ]
 
-    def __init__(self):
+    def __init__(self, rate = RATE, timeouts = TIMEOUTS, journal = None):
         CompetitionRunner.__init__(self, [], 0)
-        self.identities = [] 
+        self.rate = rate
+        self.timeouts = timeouts
+        self.latencies = {}
+        self.journal = None
+        if journal is not None:
+            self.journal = Journal(journal)
+        # Capabilities of the clients that identified themselves as bots.
+        self.identities = {}
+        # Private channels of bots that multiplex games, and if they joined.
+        self.botchannels = {}
+        # Routing of messages by channel, to the bot playing in each player
+        # channel and to all the bots of each game channel.
+        self.seats = {}
+        self.tables = {}
+        # Bots connected via the binary protocol, and numbers for their games.
+        self.connections = {}
+        self.numbers = itertools.count(1)
+        # Bots whose code is loaded in this process, by name, and nicknames
+        # of the clients that host bots with other names.
+        self.local = {}
+        self.hosts = {}
+        # Clients that disconnected, and are expected to resume their games.
+        self.away = {}
+        self.resuming = {}
+        self.resumed = {}
+        self.spectators = Spectators()
+        # Connection to the coordinator when playing games for it as a
+        # shard, or if the games are played by shards.
+        self.upstream = None
+        self.sharded = False
+        self.shards = set()
+        self.prefix = '#game-'
+        # Pending PLAY requests by number, including those being played.
+        self.upcoming = FairQueue()
+        self.requests = {}
+        self.counter = itertools.count(self.journal.last + 1 if self.journal else 1)
+
+    def listen(self, address):
+        """Accept bots using the binary protocol, on a TCP port or a path
+        for a Unix socket."""
+        StreamServer(bind(address), lambda s, a: BinaryConnection(self, s).serve()).start()
+
+    def leave(self, user):
+        for name in [user] + [n for n, h in self.hosts.items() if h == user]:
+            if name in self.competitors:
+                self.competitors.remove(name)
+
+    def returned(self, nick):
+        """Wait for a client that disconnected to come back, if it does."""
+        away = self.away.get(nick)
+        if away is not None and not away.wait(RESUME):
+            # Give up on it, so other games don't wait for it too.
+            if self.away.get(nick) is away:
+                del self.away[nick]
+
+    def reconnected(self, nick, since):
+        """Tell if a client resumed its session since the given time."""
+        self.returned(nick)
+        return self.resumed.get(nick, (0.0, {}))[0] > since
+
+    def rejoined(self, nick, counts):
+        """Carry on the games of a client that resumed its session, given
+        how many messages it received in each."""
+        self.resumed[nick] = (time.time(), counts)
+        away = self.away.pop(nick, None)
+        if away is not None:
+            away.set()
+        for s in list(self.shards):
+            s.resumed(nick, counts)
+
+    def identify(self, nick, params):
+        """Note the capabilities of a bot's client, and the names of all the
+        bots it hosts if it's given any, e.g. BOT MULTIPLEX HOSTS Alice Bob."""
+        names = []
+        if 'HOSTS' in params:
+            names = params[params.index('HOSTS')+1:]
+            params = params[:params.index('HOSTS')]
+        caps = set([c.upper() for c in params])
+        self.identities[nick] = caps
+
+        if names and nick in self.competitors:
+            self.competitors.remove(nick)
+        for name in names:
+            self.identities[name] = caps
+            self.hosts[name] = nick
+            if name not in self.competitors:
+                self.competitors.append(name)
+
+    def register(self, bots):
+        """Host bot classes in this process, so they play without sending
+        messages over IRC."""
+        for bot in bots:
+            self.local[bot.__name__] = bot
+            self.competitors.append(bot.__name__)
+        names = self.local.keys()
+        for bot in bots:
+            if hasattr(bot, 'onCompetitionStarting'):
+                bot.onCompetitionStarting(names)
+
+    def coordinate(self, port):
+        """Have games played by shards connecting on a local port, rather
+        than in this process."""
+        self.sharded = True
+        StreamServer(('127.0.0.1', port), lambda s, a: Shard(self, s).serve()).start()
+
+    def shard(self, address, index):
+        """Play games for the coordinator at the given address, in channels
+        that don't clash with those of other shards."""
+        host, _, port = address.rpartition(':')
+        # The coordinator may still be starting up, so retry for a while.
+        delay = 0.1
+        while True:
+            try:
+                self.upstream = socket.create_connection((host or 'localhost', int(port)))
+                break
+            except socket.error:
+                if delay > 10.0:
+                    raise
+                gevent.sleep(delay)
+                delay *= 2
+        self.stream = self.upstream.makefile('rw')
+        self.lock = Semaphore()
+        self.prefix = '#game-%i-' % (index)
+
+    def _shard(self):
+        slots = queue.Queue()
+        Greenlet.spawn(self._receive, slots)
+        while True:
+            slots.put(self.scheduler.acquire())
+            with self.lock:
+                distributed.send(self.stream, {'ready': True})
+
+    def _receive(self, slots):
+        while True:
+            try:
+                msg = distributed.receive(self.stream)
+            except socket.error:
+                # Games in progress will be played again by other shards.
+                print >>sys.stderr, 'Lost connection to coordinator.'
+                os._exit(-1)
+            if 'resumed' in msg:
+                self.rejoined(msg['resumed'], msg['counts'])
+                continue
+            for name, caps in msg['identities'].items():
+                self.identities[name] = set(caps)
+            self.hosts.update(msg['hosts'])
+            request = Request(msg['request'], None, msg['candidates'], 1)
+            request.take()
+            Greenlet.spawn(self._play, slots.get(), request)
+
+    def connect(self, connection):
+        for name in connection.names:
+            self.connections[name] = connection
+            self.identities[name] = set(['BINARY'])
+            self.competitors.append(name)
+
+    def disconnect(self, connection):
+        for name in connection.names:
+            if self.connections.get(name) is connection:
+                del self.connections[name]
+                self.competitors.remove(name)
+
+    def joinBotChannel(self, name, channel):
+        if channel not in self.botchannels:
+            self.botchannels[channel] = Event()
+            self.outbox.command('join', channel)
+            self.outbox.command('invite', name, channel)
+        return self.botchannels[channel]
+
+    def latency(self, name):
+        if name not in self.latencies:
+            self.latencies[name] = Latency(self.timeouts)
+        return self.latencies[name]
+
+    def show(self):
+        for bot in self.local.values():
+            if hasattr(bot, 'onCompetitionFinished'):
+                bot.onCompetitionFinished()
+        CompetitionRunner.show(self)
+        if self.journal:
+            self.journal.write('shown')
+        latencies = [l for l in self.latencies.items() if l[1].calls]
+        if not latencies:
+            return
+
+        self.echo("TIMEOUTS\t\t\t(calls,\t\taverage,\tdeadline)")
+        for name, l in sorted(latencies):
+            self.echo(" ", '{0:<16s}'.format(name), l)
+            l.calls, l.timeouts = 0, 0
+        self.echo("")
+
+    def chat(self, text):
+        self.outbox.msg('#resistance', text, CHATTER)
 
     def echo(self, *args):
-        self.client.msg('#resistance', ' '.join([str(a) for a in args]))
+        self.chat(' '.join([str(a) for a in args]))
 
-    def run(self, game):
-        t = time.time()
+    def run(self, game, requester = None):
         GAMES = 1
 
         for s in '\t,.!;?': game = game.replace(s, ' ')
@@ -228,10 +1275,11 @@ class ResistanceCompetitionHandler(CompetitionRunner):
         
         missing = [c for c in candidates if c.strip('@') not in self.competitors]
         if len(missing) != 0:
-            self.client.msg('#resistance', 'ERROR. %s was not found in %s.' % (' '.join(missing), self.competitors))
+            self.chat('ERROR. %s was not found in %s.' % (' '.join(missing), self.competitors))
             assert len(missing) == 0, "Not all specified players were found."
     
-        self.client.msg('#resistance', 'PLAYING %s!' % (' '.join(candidates)))
+        number = next(self.counter)
+        self.chat('PLAYING %s! REQUEST %i.' % (' '.join(candidates), number))
 
         # Put an '@' in front of humans when specifying the players.
         bots = [c for c in candidates if '@' not in c]
@@ -245,152 +1293,323 @@ class ResistanceCompetitionHandler(CompetitionRunner):
         if len(candidates) > 5:
             candidates = random.sample(candidates, 5)
 
-        results = queue.Queue()
-        for i in range(0, GAMES):
-            self.upcoming.put((candidates, results))
-        
-        wins = 0
-        timeouts = 0
-        for i in range(0, GAMES):
-            r = results.get()
-            if r is not None:
-                wins += int(r)
-            else:
-                timeouts += 1
+        request = Request(number, requester, candidates, GAMES)
+        if self.journal:
+            self.journal.request(request)
+        self.serve(request)
 
+    def resume(self, request):
+        """Carry on with a request recovered from the journal once all its
+        players are back."""
+        while [c for c in request.candidates if c.strip('@') not in self.competitors]:
+            gevent.sleep(1.0)
+        self.chat('RESUMING %s! REQUEST %i, %i of %i played.' % (' '.join(request.candidates), request.number, request.played, request.games))
+        self.serve(request)
+
+    def serve(self, request):
+        t = time.time()
+        number = request.number
+        # Blocks while too many requests are waiting to be played already.
+        self.requests[number] = request
+        try:
+            # Nothing to wait for when no games were asked for, as in PLAY 0.
+            if request.remaining > 0:
+                self.upcoming.put(request)
+                request.finished.wait()
+        finally:
+            del self.requests[number]
+        if self.journal:
+            self.journal.write('done', request = number)
+            if self.journal.records > Journal.RECORDS:
+                self.journal.compact(self.requests.values())
+
+        GAMES = request.played
+        timeouts = request.timeouts
         seconds = (time.time() - t)
-        if GAMES > 1:
-            self.client.msg('#resistance', 'PLAYED %i games in %0.2fs, at %0.2f GPS.%s' % (GAMES, seconds, float(GAMES)/seconds, (' WARNING: %i timed out!' % timeouts) if timeouts else ' '))
+        if request.cancelled:
+            self.chat('CANCELLED request %i after %i of %i games.' % (number, GAMES, request.games))
+        if GAMES == 0:
+            return
+        elif GAMES > 1:
+            played = GAMES - request.resumed
+            self.chat('PLAYED %i games in %0.2fs, at %0.2f GPS.%s' % (GAMES, seconds, float(played)/seconds, (' WARNING: %i timed out!' % timeouts) if timeouts else ' '))
         else:
             if timeouts > 0:
-                self.client.msg('#resistance', 'TIMEOUT for game, took %0.2fs.' % (seconds))
+                self.chat('TIMEOUT for game, took %0.2fs.' % (seconds))
             else:
-                self.client.msg('#resistance', 'PLAYED game in %0.2fs.' % (seconds))
+                self.chat('PLAYED game in %0.2fs.' % (seconds))
         self.show()
 
-    def _play(self, count, candidates, result):
-        channel = "#game-%04i" % (count+1)
-        players = [ProxyBot(bot.lstrip('@'), self.client, channel, bot.lstrip('@') in self.identities) for bot in candidates]
+    def proxy(self, name, channel, number):
+        # Bots running in this process take their seat directly.
+        if name in self.local:
+            return self.local[name]
+        if name in self.connections:
+            return BinaryBot(name, self, channel, self.connections[name], number)
+        return ProxyBot(name, self, channel, name in self.identities, number)
+
+    def progress(self):
+        if not self.requests:
+            self.chat('PROGRESS. No games requested.')
+        for n, r in sorted(self.requests.items()):
+            self.chat('PROGRESS. %r' % (r))
+
+    def cancel(self, number, requester):
+        request = self.requests.get(number)
+        if request is None or request.requester != requester:
+            self.chat('ERROR. No request %i by %s to cancel.' % (number, requester))
+            return
+        self.upcoming.cancel(request)
+
+    def record(self, request, won, statistics):
+        if self.upstream:
+            with self.lock:
+                distributed.send(self.stream, {'request': request.number, 'won': won, 'statistics': statistics})
+            return
+        if self.sharded:
+            competition.mergeStatistics(statistics)
+        if self.journal:
+            self.journal.write('game', request = request.number, won = won, statistics = statistics)
+        request.complete(won)
+        # Large requests may take a while, so don't wait for them to finish.
+        if self.journal and self.journal.records > Journal.RECORDS:
+            self.journal.compact(self.requests.values())
+
+    def _play(self, count, request):
+        candidates = request.candidates
+        channel = "%s%04i" % (self.prefix, count+1)
+        number = next(self.numbers)
+        timeout = False
         try:
-            g = self.play(CompetitionRound, players, channel)
-            result.put(g.won)
+            players = [self.proxy(bot.lstrip('@'), channel, number) for bot in candidates]
+            # Only remote players need messages routed to them.
+            self.tables[channel] = [p for p in players if isinstance(p, ProxyBot)]
+            g = self.play(lambda bots: SpectatedRound(bots, self.spectators), players, channel)
+            self.record(request, g.won, dict([(n, s.dump()) for n, s in g.statistics.items()]))
         except Timeout, t:
-            result.put(None)
-        self.channels.put(count)
+            timeout = True
+            self.record(request, None, {})
+        except Exception:
+            # A bot that fails only loses this game, like one that times out.
+            logging.exception('Game in %s failed.' % (channel))
+            self.record(request, None, {})
+        finally:
+            for p in self.tables.pop(channel, []):
+                self.seats.pop(p.channel, None)
+            self.scheduler.release(count, timeout)
     
     def _loop(self):
-        # Allocate a pool of 100 channels for playing games.
-        self.channels = queue.Queue()
-        for i in range(0, CHANNELS):
-            self.channels.put(i)
-
-        self.upcoming = queue.Queue()
         while True:
-            candidates, result = self.upcoming.get()
-            if not candidates or not result:
-                break 
-            index = self.channels.get()
-            Greenlet.spawn(self._play, index, candidates, result)
+            request = self.upcoming.get()
+            if request is None:
+                break
+            index = self.scheduler.acquire()
+            Greenlet.spawn(self._play, index, request)
 
     def __call__(self, client, msg):
         if msg.command == '001':
             self.client = client
-            client.send_message(message.Join('#resistance'))
-            Greenlet.spawn(self._loop)
+            self.outbox = Outbox(client, self.rate)
+            self.scheduler = Scheduler(self.outbox)
+            if self.upstream:
+                Greenlet.spawn(self._shard)
+                return
+            self.outbox.command('join', '#resistance')
+            if not self.sharded:
+                Greenlet.spawn(self._loop)
+            if self.journal:
+                for r in self.journal.requests.values():
+                    Greenlet.spawn(self.resume, self.journal.recover(r))
+                self.journal.requests = {}
         elif msg.command == 'PING':
-            client.send_message(message.Command(msg.params, 'PONG'))
+            client.pong(msg.params)
         elif msg.command == '353':
             if msg.params[2] != '#resistance':
                 # When joining specific bot private channels, see if the bot is
                 # already there waiting and don't require rejoin.
                 waiting = [u.strip('+@') for u in msg.params[3:]]
-                for g in self.games:
-                    for b in [b for b in g.bots if b.name in waiting]:
-                        if b.channel == msg.params[2] and b._join and not b._join.ready():
-                            b._join.set()
+                if msg.params[2] in self.botchannels:
+                    if msg.params[2][len('#bot-'):] in waiting:
+                        self.botchannels[msg.params[2]].set()
+                    return
+                b = self.seats.get(msg.params[2])
+                if b and b.host in waiting and b._join and not b._join.ready():
+                    b._join.set()
                 return
 
-            self.competitors = [u.strip('+@') for u in msg.params[3:]]
-            self.competitors.remove(client.nick)
+            users = [u.strip('+@') for u in msg.params[3:]]
+            users.remove(client.nick)
+            self.competitors = [u for u in users if u not in self.hosts.values()]
+            self.competitors.extend([n for n, h in self.hosts.items() if h in users])
+            self.competitors.extend(self.connections)
+            self.competitors.extend(self.local)
 
         elif msg.command == 'JOIN':
             user = msg.prefix.split('!')[0].strip('+@')
             if user == client.nick:
                 return
             channel = msg.params[0].lstrip(':')
-            if channel != '#resistance':
-                for g in self.games:
-                    for b in g.bots:
-                        if b.channel == channel and b._join:
-                            b._join.set()
-                            return
-                assert False, "Not waiting for a player to join this channel."
-            else:
+            if channel in self.botchannels:
+                self.botchannels[channel].set()
+            elif channel != '#resistance':
+                # Bots resuming a session join the channels of their games,
+                # which may have finished in the meantime.
+                b = self.seats.get(channel)
+                if b and b._join:
+                    b._join.set()
+            elif user not in self.competitors:
                 self.competitors.append(user)
+        elif msg.command == 'QUIT':
+            # Games wait a while for bots to reconnect and resume.
+            user = msg.prefix.split('!')[0].strip('+@')
+            self.leave(user)
+            # Only for bots that are playing, as others have nothing to resume.
+            if user in self.identities and any([p.host == user for t in self.tables.values() for p in t]):
+                self.away[user] = Event()
         elif msg.command == 'PART':
             user = msg.prefix.split('!')[0].strip('+@')
             if user == client.nick:
                 return
             channel = msg.params[0].lstrip(':')
             if channel == '#resistance':
-                self.competitors.remove(user)
+                self.leave(user)
+                return
+            elif channel in self.botchannels:
+                # Join again and wait for the bot on its next game.
+                self.outbox.command('part', channel)
+                del self.botchannels[channel]
                 return
             else:
-                for g in self.games:
-                    for b in g.bots:
-                        if b.channel == channel and b._part:
-                            # Only leave the channel once the other has left, to avoid
-                            # synchronization problems when batch processing games.
-                            b._part.set()
-                            return
+                b = self.seats.get(channel)
+                if b and b._part:
+                    # Only leave the channel once the other has left, to avoid
+                    # synchronization problems when batch processing games.
+                    b._part.set()
         elif msg.command == 'PRIVMSG':
             channel = msg.params[0].lstrip(':')
             if channel == '#resistance':
+                requester = msg.prefix.split('!')[0]
                 if msg.params[1] == 'PLAY':
-                    self.run(' '.join(msg.params[2:]))
+                    self.run(' '.join(msg.params[2:]), requester)
+                elif msg.params[1] == 'PROGRESS':
+                    self.progress()
+                elif msg.params[1] == 'CANCEL':
+                    self.cancel(int(msg.params[2].strip('.,!;')), requester)
+                elif msg.params[1] == 'STATUS':
+                    self.chat(self.outbox.status())
+                    self.chat(self.scheduler.status())
+                    self.chat('SPECTATORS %i, %i dropped.' % (len(self.spectators.subscribers), self.spectators.dropped))
                 return
             if msg.params[1] == 'BOT':
-                self.identities.append(msg.prefix.split('!')[0])
-            for g in self.games:    
-                # First check if this is a report message about sabotages in
-                # games played between humans alone or with bots.
-                if g.channel == channel and msg.params[1].upper() == 'SABOTAGES':
-                    remaining = int(msg.params[2].strip('.,!;')) 
-                    for bot in g.bots:
-                        if bot._sabotage is not None:
-                            bot.send("SABOTAGES %i" % (remaining))
-                            if bot.spy:
-                                bot._sabotage.set(bool(remaining > 0))
-                                remaining -= 1
-                            else:
-                                bot._sabotage.set(False)
-
-                # Now check if a bot is expecting a message, and pass it along.
-                for bot in g.bots:
-                    if bot.channel != channel:
-                        continue
-                    name = 'process_'+msg.params[1].upper()
-                    if name == 'process_COMMENT':
-                        pass
-                    elif hasattr(bot, name):
-                        process = getattr(bot, name)
-                        process(msg.params)
-                    elif bot.expecting:
-                        bot.expecting(msg.params)
+                self.identify(msg.prefix.split('!')[0], msg.params[2:])
+            elif msg.params[1] in ('RESUMING', 'RESUME'):
+                # Clients list how many messages they processed in each game,
+                # over several lines if needed, e.g. RESUME #game-0001.12-player-2 7.
+                nick = msg.prefix.split('!')[0]
+                counts = self.resuming.setdefault(nick, {})
+                pairs = msg.params[2:]
+                for channel, count in zip(pairs[::2], pairs[1::2]):
+                    counts[channel] = int(count)
+                if msg.params[1] == 'RESUME':
+                    self.rejoined(nick, self.resuming.pop(nick))
+            if channel in self.botchannels:
+                # Messages from multiplexed games are prefixed by the name of
+                # the channel they'd otherwise be sent from.
+                channel = msg.params[1]
+                msg.params = [channel] + msg.params[2:]
+
+            # First check if this is a report message about sabotages in
+            # games played between humans alone or with bots.
+            if channel in self.tables and msg.params[1].upper() == 'SABOTAGES':
+                remaining = int(msg.params[2].strip('.,!;')) 
+                for bot in self.tables[channel]:
+                    if bot._sabotage is not None:
+                        bot.send("SABOTAGES %i" % (remaining))
+                        if bot.spy:
+                            bot._sabotage.set(bool(remaining > 0))
+                            remaining -= 1
+                        else:
+                            bot._sabotage.set(False)
+
+            # Now check if a bot is expecting a message, and pass it along.
+            bot = self.seats.get(channel)
+            if bot is None:
+                return
+            name = 'process_'+msg.params[1].upper()
+            if name == 'process_COMMENT':
+                pass
+            elif hasattr(bot, name):
+                process = getattr(bot, name)
+                process(msg.params)
+            elif bot.expecting:
+                bot.expecting(msg.params)
  
 
 if __name__ == '__main__':
     
+    # Optional settings are given as rate=200, timeouts=0.25:5.0,
+    # journal=path or journal= to disable it, wire=6668 or wire=/path, and
+    # shards=4 to play games in that many processes coordinated on port 6669 or
+    # coordinator=[host:]port, bots=bots,aigd.Statistician to host bots in the
+    # moderator itself, and spectate=6670 or spectate=/path to publish game
+    # events, which shards do on 6671, 6672... or /path.1, /path.2...
+    options = dict([a.split('=', 1) for a in sys.argv[1:] if '=' in a])
+    arguments = [a for a in sys.argv[1:] if '=' not in a]
+
+    # Shards can't reach bots connected over the wire to the coordinator.
+    if 'wire' in options and 'shards' in options:
+        print 'USAGE: server.py can\'t take both wire= and shards=.'
+        sys.exit(-1)
+
     server = 'localhost'
-    if len(sys.argv) > 1:
-        server = sys.argv[1]
+    if len(arguments) > 0:
+        server = arguments[0]
+    rate = RATE
+    if 'rate' in options:
+        rate = float(options['rate'])
+    timeouts = TIMEOUTS
+    if 'timeouts' in options:
+        timeouts = tuple([float(t) for t in options['timeouts'].split(':')])
+
+    journal = options.get('journal', JOURNAL) or None
+    coordinator = options.get('coordinator', str(COORDINATOR))
+
+    nick = 'aigamedev'
+    shards = []
+    if 'shard' in options:
+        # Shards only play games, the coordinator keeps track of them.
+        nick = 'aigamedev-%s' % (options['shard'])
+        journal = None
 
-    irc = Client(server, 'aigamedev',  port=6667, local_hostname='localhost')
-    h = ResistanceCompetitionHandler()
-    irc.add_handler(h)
+    irc = Client(server, nick,  port=6667, local_hostname='localhost')
+    h = ResistanceCompetitionHandler(rate, timeouts, journal)
+    irc.add_handler(IrcTransport(irc, h))
+    if 'bots' in options:
+        h.register(getCompetitors(options['bots'].split(',')))
+    if 'shard' in options:
+        h.shard(coordinator, int(options['shard']))
+    elif 'shards' in options:
+        # Listen before starting the shards, so they can connect right away.
+        port = coordinator.rpartition(':')[2]
+        h.coordinate(int(port))
+        for i in range(1, int(options['shards'])+1):
+            spectate = []
+            if 'spectate' in options:
+                address = options['spectate']
+                spectate = ['spectate=%s' % (str(int(address) + i) if address.isdigit() else '%s.%i' % (address, i))]
+            shards.append(subprocess.Popen([sys.executable, __file__, server, 'shard=%i' % i, 'coordinator=localhost:%s' % port]
+                                           + ['%s=%s' % o for o in options.items() if o[0] in ('rate', 'timeouts', 'bots')]
+                                           + spectate))
+    if 'wire' in options:
+        h.listen(options['wire'])
+    if 'spectate' in options:
+        h.spectators.listen(options['spectate'])
     try:
         irc.start()
         irc.join()
     except KeyboardInterrupt:
-        h.upcoming.put(([], None))
+        h.upcoming.close()
+    finally:
+        for s in shards:
+            s.terminate()
 
@@ -11,6 +11,10 @@ class Variable(object):
         self.minimum = min(self.minimum, value)
         self.maximum = min(self.maximum, value)
 
+    def merge(self, other):
+        self.total += other.total
+        self.samples += other.samples
+
     def estimate(self):
         if self.samples > 0:
             return float(self.total) / float(self.samples)
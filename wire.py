@@ -0,0 +1,57 @@
+"""Compact binary protocol for games between bots, used by server.py and
+client.py over plain TCP or Unix sockets instead of IRC.  Each message is a
+frame prefixed by its length, with an opcode, the game number and the seat of
+the bot it's for.  Players are referred to by their seat index, and teams or
+votes as bitmasks of seats."""
+
+import struct
+
+
+HELLO, REVEAL, MISSION, SELECT, SELECTED, VOTE, VOTED, VOTES, \
+SABOTAGE, SABOTAGED, SABOTAGES, RESULT = range(12)
+
+LENGTH = struct.Struct('!H')
+HEADER = struct.Struct('!BIB')
+
+
+def pack(opcode, game, seat, *values):
+    """Frame body with the given header followed by single byte values."""
+    return HEADER.pack(opcode, game, seat) + ''.join([chr(v) for v in values])
+
+def frame(data):
+    return LENGTH.pack(len(data)) + data
+
+def unpack(data):
+    """Returns the opcode, game, seat and payload of a frame body."""
+    opcode, game, seat = HEADER.unpack_from(data)
+    return opcode, game, seat, data[HEADER.size:]
+
+def read(stream):
+    """Reads the next frame body from a file-like stream, None once closed."""
+    header = stream.read(LENGTH.size)
+    if len(header) < LENGTH.size:
+        return None
+    length, = LENGTH.unpack(header)
+    data = stream.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
+def mask(players):
+    return sum([1 << (p.index-1) for p in players])
+
+def unmask(bits, players):
+    return [p for p in players if bits & (1 << (p.index-1))]
+
+
+def packNames(names):
+    return ''.join([chr(len(n[:255])) + n[:255] for n in names])
+
+def unpackNames(data):
+    names = []
+    while data:
+        length = ord(data[0])
+        names.append(data[1:length+1])
+        data = data[length+1:]
+    return names